@@ -6,24 +6,45 @@ from twilio.request_validator import RequestValidator
 
 from functools import wraps
 import boto3
-import re
 import sys
 import requests
 import datetime
+import time
 from suntime import Sun
 from dateutil import tz
-from geopy.geocoders import Nominatim, GeoNames
+from geopy.geocoders import GeoNames
 import os
 import phonenumbers
 import uuid
 from dotenv import load_dotenv
 
+from sunburst import SunburstError, default_client as sunburst_client
+from client_lookup import ClientLookup
+from cache import cached
+from gazetteer import default_gazetteer
+from geocoding import GeocodeError, default_geocoder
+from ratelimit import CreateLimiter, client_ip
+from profiling import profile_request
+from warmer import ForecastStore, ForecastWarmer
+
 
 load_dotenv()
 
 #  ================== Global Variables ==================
 clients = []
 
+INVALID_LOCATION_MSG = "Invalid location. Please enter valid address."
+THROTTLED_MSG = "Too many Sunburst requests. Try again later."
+GEOCODE_UNAVAILABLE_MSG = "Location lookup is unavailable right now. Try again later."
+# Seconds a reply may spend waiting on Sunburst, well inside Twilio's
+# 15 second webhook timeout
+REPLY_TIMEOUT = float(os.getenv("SUNBURST_REPLY_TIMEOUT", "8"))
+
+
+class ForecastError(Exception):
+    """Raised when there is no forecast to send for a location.
+        The message is the reply to send instead"""
+
 
 #  ================== reCaptcha ==================
 def validate_recaptcha(token):
@@ -65,13 +86,12 @@ def refresh_clients():
     return all_clients
 
 
+client_lookup = ClientLookup(db_client)
+
+
 def client_exists(phone_number):
     """Check if phone number exists in DB"""
-    for i in range(len(clients)):
-        client = clients[i]
-        if client["Phone"] == phone_number:
-            return True
-    return False
+    return client_lookup.get(phone_number) is not None
 
 
 def create_client(phone_number, role="", location=""):
@@ -85,6 +105,7 @@ def create_client(phone_number, role="", location=""):
             "Location": location,
         }
     )
+    client_lookup.invalidate(phone_number=phone_number)
     return response
 
 
@@ -100,34 +121,32 @@ def update_row(client_id, key, value):
         ExpressionAttributeValues={
             ":VALUE": value
         }, ReturnValues="UPDATED_NEW")
+    client_lookup.updated(client_id, key, value)
     return response
 
 
 def get_client_role(phone_number):
     """Get client permission level given phone number"""
-    for i in range(len(clients)):
-        client = clients[i]
-        if client["Phone"] == phone_number and "Role" in client:
-            return client["Role"]
-    return None
+    client = client_lookup.get(phone_number)
+    if client is None:
+        return None
+    return client.get("Role")
 
 
 def get_client_location(phone_number):
     """Get location of client given phone number"""
-    for i in range(len(clients)):
-        client = clients[i]
-        if client["Phone"] == phone_number and "Location" in client:
-            return client["Location"]
-    return None
+    client = client_lookup.get(phone_number)
+    if client is None:
+        return None
+    return client.get("Location")
 
 
 def get_client_id(phone_number):
     """Get client Id given phone number"""
-    for i in range(len(clients)):
-        client = clients[i]
-        if client["Phone"] == phone_number:
-            return client["Id"]
-    return None
+    client = client_lookup.get(phone_number)
+    if client is None:
+        return None
+    return client["Id"]
 
 
 def update_conversation(client_id, message):
@@ -171,8 +190,9 @@ def validate_twilio_request(f):
     return decorated_function
 
 
-def send_msg(phone_number, msg):
-    """Send text MSG to PHONE_NUM"""
+def send_msg(phone_number, msg, client_id=None):
+    """Send text MSG to PHONE_NUM and log it under CLIENT_ID, looked up
+        by phone if not given"""
     client = Client(os.getenv("TWILIO_AUTH_SID"),
                     os.getenv("TWILIO_AUTH_TOKEN"))
     client.messages.create(
@@ -181,27 +201,61 @@ def send_msg(phone_number, msg):
         to=phone_number
     )
     try:
-        update_conversation(get_client_id(phone_number), msg)
+        update_conversation(client_id or get_client_id(phone_number), msg)
     except:
         pass
     return '"{}" sent to {}'.format(msg, phone_number)
 
+#  ================== Rate Limiting ==================
+create_limiter = CreateLimiter()
+
+
+def request_ip():
+    """Get the client IP to rate limit on"""
+    return client_ip(request.headers, request.remote_addr)
+
+
+def limit_create(f):
+    """Reject signup floods with 429 before any upstream work"""
+    @ wraps(f)
+    def decorated_function(*args, **kwargs):
+        if create_limiter.check(request_ip(), request.values.get("phone")):
+            return "Too many requests", 429
+        if not create_limiter.enter():
+            return "Too many requests", 429
+        try:
+            return f(*args, **kwargs)
+        finally:
+            create_limiter.leave()
+    return decorated_function
+
 #  ================== Sunset ==================
 
 
+@cached("geocode")
 def address_to_coord(city_name):
     """Get coords of address"""
-    geolocator = Nominatim(user_agent="sundown")
-    location = geolocator.geocode(city_name)
+    # ZIP codes and city names resolve offline
+    gazetteer = default_gazetteer()
+    place = gazetteer and gazetteer.lookup(city_name)
+    if place:
+        return place[0]
+
+    location = default_geocoder().geocode(city_name)
     if location is None:
         return -1
     return (location.latitude, location.longitude)
 
 
+@cached("address")
 def cleaned_address(address):
     """Get cleaned address"""
-    geolocator = Nominatim(user_agent="sundown")
-    location = geolocator.geocode(address)
+    gazetteer = default_gazetteer()
+    place = gazetteer and gazetteer.lookup(address)
+    if place:
+        return place[1]
+
+    location = default_geocoder().geocode(address)
     if location is None:
         return -1
     return (location.address)
@@ -227,33 +281,69 @@ def generate_grid(coord_tuple):
     return coords
 
 
-def get_sunset(address, from_grid=True):
-    """Get sunset quality and parse into message"""
+@cached("timezone")
+def get_timezone(coords):
+    """Get timezone name of coords"""
+    gazetteer = default_gazetteer()
+    timezone = gazetteer and gazetteer.nearest_timezone(coords)
+    if timezone:
+        return timezone
 
-    # Load Sunburst API credentials
-    EMAIL = os.getenv("SUNBURST_EMAIL")
-    PASSWORD = os.getenv("SUNBURST_PW")
-    url = "https://sunburst.sunsetwx.com/v1/login"
+    GEO_USERNAME = os.getenv("GEONAMES_USERNAME")
+    geolocator = GeoNames(username=GEO_USERNAME)
+    timezone = geolocator.reverse_timezone(coords)
+    return str(timezone)
 
-    # Get Sunburst API token via POST
-    res = requests.post(url, auth=(EMAIL, PASSWORD))
 
-    # res = requests.post(url, data=payload)
-    result = re.findall(r'token\":\"[0-9a-xA-Z-]*', res.text)
-    token = "Bearer " + result[0][8:]
+def forecast_message(address, kind="sunset", from_grid=True, timeout=None):
+    """Get sunrise or sunset quality and parse into message.
+        Give up on Sunburst after TIMEOUT seconds in total.
+        Raises ForecastError if there is no forecast"""
 
-    # Get sunset quality via Sunburst GET
-    headers = {"Authorization": token}
-    url = "https://sunburst.sunsetwx.com/v1/quality"
+    # Serve from the warmer when it has already resolved this location.
+    # Only the warming process has entries, other workers get its results
+    # through the shared geocode, timezone and forecast caches
+    warm = forecast_store.get(address) if from_grid else None
+    if warm is not None:
+        try:
+            return format_forecast(address, kind, warm.coords,
+                                   warm.quality_percent(kind), warm.timezone)
+        except SunburstError:
+            pass
 
     # Return if invalid coords
-    coords = address_to_coord(address)
+    try:
+        coords = address_to_coord(address)
+    except GeocodeError:
+        raise ForecastError(GEOCODE_UNAVAILABLE_MSG)
     if coords == -1:
-        return "Invalid location. Please enter valid address."
+        raise ForecastError(INVALID_LOCATION_MSG)
 
     total = 0
 
     # Get coordinates and quality at each coord
+    coords_list = grid_coords(coords, from_grid)
+
+    # Get quality via Sunburst, shared and rate limited across requests.
+    # Sunrise and sunset records come back together, so asking for the
+    # other event later is served from the client's cache
+    sunburst = sunburst_client()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for coord in coords_list:
+        try:
+            quality_percent = sunburst.quality_percent(coord, kind, deadline)
+        except SunburstError:
+            raise ForecastError(THROTTLED_MSG)
+
+        total += quality_percent
+
+    quality_percent = total / float(len(coords_list))
+    return format_forecast(address, kind, coords, quality_percent,
+                           get_timezone(coords))
+
+
+def grid_coords(coords, from_grid=True):
+    """Get "lat,lng" strings to average quality over"""
     coords_list = []
 
     # If calculate quality from grid, false if calculate from single coord
@@ -263,19 +353,11 @@ def get_sunset(address, from_grid=True):
             coords_list = [str(coords[0]) + "," + str(coords[1])]
         else:
             coords_list = [str(coords[0]) + "," + str(coords[1])]
+    return coords_list
 
-    for coord in coords_list:
-        data = {"geo": coord}
-        res = requests.get(url, headers=headers, params=data)
-        try:
-            quality_percent = re.findall(
-                r'quality_percent\":\d*\.\d*', res.text)[0][17:]
-        except:
-            return "Too many Sunburst requests. Try again later."
-
-        total += float(quality_percent)
 
-    quality_percent = total / float(len(coords_list))
+def format_forecast(address, kind, coords, quality_percent, timezone):
+    """Parse sunrise or sunset quality into message"""
     quality = ""
 
     if quality_percent < 25:
@@ -287,16 +369,16 @@ def get_sunset(address, from_grid=True):
     else:
         quality = "Great"
 
-    # Get today's sunset in local time
+    # Get today's sunrise or sunset in local time
     sun = Sun(coords[0], coords[1])
-    today_ss = sun.get_sunset_time()
+    if kind == "sunrise":
+        today_ss = sun.get_sunrise_time()
+    else:
+        today_ss = sun.get_sunset_time()
 
     # Convert time zone
-    GEO_USERNAME = os.getenv("GEONAMES_USERNAME")
-    geolocator = GeoNames(username=GEO_USERNAME)
-    timezone = geolocator.reverse_timezone(coords)
     from_zone = tz.gettz("UTC")
-    to_zone = tz.gettz(str(timezone))
+    to_zone = tz.gettz(timezone)
     today_ss = today_ss.replace(tzinfo=from_zone)
     sunset_time = today_ss.astimezone(to_zone)
 
@@ -306,12 +388,74 @@ def get_sunset(address, from_grid=True):
     day = day_list[datetime.datetime.today().weekday()]
 
     # Create message
-    message = "Quality: " + quality + " " + str(round(quality_percent, 2)) + "%\nSunset at {}pm".format(
+    event = "Sunrise at {}am" if kind == "sunrise" else "Sunset at {}pm"
+    message = "Quality: " + quality + " " + str(round(quality_percent, 2)) + "%\n" + event.format(
         sunset_time.strftime("%H:%M")) + "\n\n" + day + " at " + address
 
     return message
 
 
+def get_forecast(address, kind="sunset", from_grid=True, timeout=None):
+    """Get forecast message, or the reason there isn't one"""
+    try:
+        return forecast_message(address, kind, from_grid, timeout)
+    except ForecastError as e:
+        return str(e)
+
+
+def get_sunset(address, from_grid=True, timeout=None):
+    """Get sunset quality and parse into message"""
+    return get_forecast(address, "sunset", from_grid, timeout)
+
+
+def get_sunrise(address, from_grid=True, timeout=None):
+    """Get sunrise quality and parse into message"""
+    return get_forecast(address, "sunrise", from_grid, timeout)
+
+
+#  ================== Forecast Warming ==================
+forecast_store = ForecastStore()
+
+
+def active_locations():
+    """Get distinct client locations from DynamoDB"""
+    table = db_client()
+    kwargs = {"ProjectionExpression": "#L",
+              "ExpressionAttributeNames": {"#L": "Location"}}
+    response = table.scan(**kwargs)
+    items = response["Items"]
+    while "LastEvaluatedKey" in response:
+        response = table.scan(
+            ExclusiveStartKey=response["LastEvaluatedKey"], **kwargs)
+        items.extend(response["Items"])
+    return sorted(set(item["Location"] for item in items
+                      if isinstance(item.get("Location"), str) and item["Location"]))
+
+
+def resolve_location(location):
+    """Resolve location into coords, timezone and grid forecasts.
+        Forecasts are fetched again and rewritten in the shared cache, so
+        other workers keep reading fresh ones"""
+    coords = address_to_coord(location)
+    if coords == -1:
+        raise ValueError("Invalid location")
+    sunburst = sunburst_client()
+    forecasts = {coord: sunburst.forecasts(coord, refresh=True)
+                 for coord in grid_coords(coords)}
+    return coords, get_timezone(coords), forecasts
+
+
+forecast_warmer = ForecastWarmer(
+    forecast_store, active_locations, resolve_location)
+
+
+def start_warmer():
+    """Start warming forecasts if WARMER_ENABLED=1. Only called by web
+        servers, so scripts importing this module never warm"""
+    if os.getenv("WARMER_ENABLED") == "1":
+        forecast_warmer.start()
+
+
 #  ================== Account Creation ==================
 
 def begin_onboard(phone_number):
@@ -330,7 +474,10 @@ def begin_onboard(phone_number):
 
 def validate_location(phone_number, location):
     """Update client location and verify that it is correct"""
-    location = cleaned_address(location)
+    try:
+        location = cleaned_address(location)
+    except GeocodeError:
+        return GEOCODE_UNAVAILABLE_MSG
     update_row(get_client_id(phone_number), "Location", location)
     return "(Yes/No) Is this the correct location? \n\n" + str(location)
 
@@ -351,19 +498,23 @@ application = Flask(__name__)
 application.config.from_object(__name__)
 
 
+# Warm only in processes that serve requests
+@ application.before_request
+def begin_warming():
+    start_warmer()
+
+
 # Route that serves all requests
 @ application.route("/", methods=["GET", "POST"])
 def render_index():
-    # Fetch clients from DB
-    # refresh_clients()
     return render_template("index.html")
 
 
 # Route that creates a new user
 @ application.route("/api/create", methods=["POST"])
+@ profile_request
+@ limit_create
 def create_route():
-    # Fetch clients from DB
-    refresh_clients()
     # Validate request
     if not validate_recaptcha(request.values.get("recaptcha_token")):
         return "Invalid request", 401
@@ -385,12 +536,10 @@ def test():
 
 # Route that handles incoming SMS
 @ application.route("/api/sms", methods=["POST"])
+@ profile_request
 @ validate_twilio_request
 def incoming_text():
 
-    # Fetch clients from DB
-    refresh_clients()
-
     # If this is a valid response
     if request.values.get("Body"):
 
@@ -422,7 +571,7 @@ def incoming_text():
                 # Reply with locatio update confirmation and new prediction
                 output_msg = "Your location has been updated to:\n" + \
                     client_curr_location + "\n\n" + \
-                    get_sunset(client_curr_location, True)
+                    get_sunset(client_curr_location, True, REPLY_TIMEOUT)
 
             elif input_msg == "no":
                 output_msg = "Please input your location again. Add more specificity like street address, city, zip code, state or country."
@@ -433,7 +582,12 @@ def incoming_text():
             # Get sundown in specified location
             if "sunset in" in input_msg or "sunset at" in input_msg or "sundown in" in input_msg or "sundown at" in input_msg:
                 location = input_msg.split(" ", 2)[2]
-                output_msg = get_sunset(location, True)
+                output_msg = get_sunset(location, True, REPLY_TIMEOUT)
+
+            # Get sunrise in specified location
+            elif "sunrise in" in input_msg or "sunrise at" in input_msg:
+                location = input_msg.split(" ", 2)[2]
+                output_msg = get_sunrise(location, True, REPLY_TIMEOUT)
 
             # Update Location
             elif "change location to" in input_msg or "change city to" in input_msg:
@@ -449,7 +603,11 @@ def incoming_text():
 
              # Refresh
             elif input_msg == "refresh" or input_msg == "update" or input_msg == "sunset" or input_msg == "sundown":
-                output_msg = get_sunset(client_curr_location, True)
+                output_msg = get_sunset(client_curr_location, True, REPLY_TIMEOUT)
+
+            # Sunrise
+            elif input_msg == "sunrise":
+                output_msg = get_sunrise(client_curr_location, True, REPLY_TIMEOUT)
 
                 # Get Help
             elif input_msg == "help" or input_msg == "info":
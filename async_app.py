@@ -0,0 +1,322 @@
+import os
+import asyncio
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import phonenumbers
+from quart import Quart, request, render_template, abort
+from twilio.twiml.messaging_response import MessagingResponse
+from twilio.request_validator import RequestValidator
+
+# boto3, twilio and geopy have no async clients, so their helpers are
+# shared with the WSGI app and run on a thread pool
+from flask_app import (client_lookup, client_exists, create_client, update_row,
+                       update_conversation, send_msg, address_to_coord,
+                       cleaned_address, get_timezone, grid_coords,
+                       format_forecast, finish_creation, forecast_store,
+                       INVALID_LOCATION_MSG, THROTTLED_MSG,
+                       GEOCODE_UNAVAILABLE_MSG, REPLY_TIMEOUT,
+                       start_warmer)
+from async_sunburst import client_from_env
+from geocoding import GeocodeError
+from sunburst import SunburstError
+from ratelimit import CreateLimiter, client_ip
+from profiling import profile_async_request
+
+
+#  ================== Event Loop Resources ==================
+app = Quart(__name__)
+
+# Threads for blocking SDK calls; bounds how many run at once
+executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ASYNC_IO_THREADS", "64")),
+    thread_name_prefix="blocking-io")
+http = None
+sunburst = None
+
+
+@app.before_serving
+async def open_clients():
+    global http, sunburst
+    http = httpx.AsyncClient(timeout=10)
+    sunburst = client_from_env(run_blocking)
+    start_warmer()
+
+
+@app.after_serving
+async def close_clients():
+    await http.aclose()
+    await sunburst.close()
+
+
+async def run_blocking(f, *args, **kwargs):
+    """Run blocking call on the I/O thread pool"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, partial(f, *args, **kwargs))
+
+
+#  ================== reCaptcha ==================
+async def validate_recaptcha(token):
+    """Validate request using reCaptcha"""
+    url = "https://www.google.com/recaptcha/api/siteverify"
+    payload = {"secret": os.getenv("RECAPTCHA_SECRET"), "response": token}
+    res = await http.post(url, params=payload)
+    return res.json().get("success")
+
+
+#  ================== Twilio ==================
+def validate_twilio_request(f):
+    """Validates that incoming requests genuinely originated from Twilio"""
+    @ wraps(f)
+    async def decorated_function(*args, **kwargs):
+        validator = RequestValidator(os.environ.get("TWILIO_AUTH_TOKEN"))
+        request_valid = validator.validate(
+            request.url,
+            await request.form,
+            request.headers.get("X-TWILIO-SIGNATURE", ""))
+        if request_valid:
+            return await f(*args, **kwargs)
+        else:
+            abort(403)
+    return decorated_function
+
+
+#  ================== Rate Limiting ==================
+create_limiter = CreateLimiter()
+
+
+def limit_create(f):
+    """Reject signup floods with 429 before any upstream work.
+        The event loop can't wait for a slot, so a full queue rejects"""
+    @ wraps(f)
+    async def decorated_function(*args, **kwargs):
+        ip = client_ip(request.headers, request.remote_addr)
+        if create_limiter.check(ip, (await request.values).get("phone")):
+            return "Too many requests", 429
+        if not create_limiter.enter(wait=False):
+            return "Too many requests", 429
+        try:
+            return await f(*args, **kwargs)
+        finally:
+            create_limiter.leave()
+    return decorated_function
+
+
+#  ================== Sunset ==================
+async def get_forecast(address, kind="sunset", from_grid=True):
+    """Get sunrise or sunset quality and parse into message"""
+    # Serve from the warmer when it has already resolved this location.
+    # Only the warming process has entries, other workers get its results
+    # through the shared geocode, timezone and forecast caches
+    warm = forecast_store.get(address) if from_grid else None
+    if warm is not None:
+        try:
+            return format_forecast(address, kind, warm.coords,
+                                   warm.quality_percent(kind), warm.timezone)
+        except SunburstError:
+            pass
+
+    try:
+        coords = await run_blocking(address_to_coord, address)
+    except GeocodeError:
+        return GEOCODE_UNAVAILABLE_MSG
+    if coords == -1:
+        return INVALID_LOCATION_MSG
+
+    # Quality at every grid point and the timezone are fetched together.
+    # Shared Sunburst calls keep running for other callers after a timeout
+    coords_list = grid_coords(coords, from_grid)
+    try:
+        results = await asyncio.wait_for(asyncio.gather(
+            run_blocking(get_timezone, coords),
+            *[sunburst.quality_percent(coord, kind) for coord in coords_list],
+            return_exceptions=True), REPLY_TIMEOUT)
+    except asyncio.TimeoutError:
+        return THROTTLED_MSG
+    timezone, percents = results[0], results[1:]
+    if isinstance(timezone, Exception):
+        raise timezone
+    if any(isinstance(p, SunburstError) for p in percents):
+        return THROTTLED_MSG
+    for p in percents:
+        if isinstance(p, Exception):
+            raise p
+
+    quality_percent = sum(percents) / float(len(percents))
+    return format_forecast(address, kind, coords, quality_percent, timezone)
+
+
+async def lookup_location(location):
+    """Clean location, or return the message to reply with instead"""
+    try:
+        cleaned_location = await run_blocking(cleaned_address, location)
+    except GeocodeError:
+        return None, GEOCODE_UNAVAILABLE_MSG
+    if cleaned_location == -1:
+        return None, "Can't find location: " + location
+    return cleaned_location, None
+
+
+#  ================== Account Creation ==================
+async def begin_onboard(phone_number):
+    """Send onboarding messages"""
+    if await run_blocking(client_exists, phone_number):
+        msg = "Account with this phone number already exists. For more information, reply HELP."
+        await run_blocking(send_msg, phone_number, msg)
+    else:
+        await run_blocking(create_client, phone_number, "Pending")
+        # Sent in order so they arrive in order
+        msg = "Welcome to Sundown, the simple way to get daily notifications of the sunset quality."
+        await run_blocking(send_msg, phone_number, msg)
+        msg = "To begin, please respond with your location. You can reply with a street address, city and state or zipcode."
+        await run_blocking(send_msg, phone_number, msg)
+    return ("Success")
+
+
+async def validate_location(client_id, location):
+    """Update client location and verify that it is correct"""
+    try:
+        location = await run_blocking(cleaned_address, location)
+    except GeocodeError:
+        return GEOCODE_UNAVAILABLE_MSG
+    await run_blocking(update_row, client_id, "Location", location)
+    return "(Yes/No) Is this the correct location? \n\n" + str(location)
+
+
+#  ================== Routes ==================
+# Route that serves all requests
+@ app.route("/", methods=["GET", "POST"])
+async def render_index():
+    return await render_template("index.html")
+
+
+# Route that creates a new user
+@ app.route("/api/create", methods=["POST"])
+@ profile_async_request
+@ limit_create
+async def create_route():
+    values = await request.values
+
+    # Validate request
+    if not await validate_recaptcha(values.get("recaptcha_token")):
+        return "Invalid request", 401
+
+    # Validate phone number
+    phone_number = values.get("phone")
+    phone_number_obj = phonenumbers.parse(phone_number, None)
+
+    if phonenumbers.is_valid_number(phone_number_obj):
+        return await begin_onboard(phone_number)
+    else:
+        return "Invalid Number", 400
+
+
+# Route that handles incoming SMS
+@ app.route("/api/sms", methods=["POST"])
+@ profile_async_request
+@ validate_twilio_request
+async def incoming_text():
+    values = await request.values
+    client_id = None
+
+    # If this is a valid response
+    if values.get("Body"):
+
+        input_msg = values.get("Body")
+        # Clean string
+        input_msg = input_msg.replace("+", " ").lower().lstrip().rstrip()
+
+        # Get requestor details with one lookup
+        client_num = values.get("From")
+        client = await run_blocking(client_lookup.get, client_num) or {}
+        client_curr_location = client.get("Location")
+        client_role = client.get("Role")
+        client_id = client.get("Id")
+
+        # Log the request while the reply is worked out
+        logged = asyncio.ensure_future(
+            run_blocking(update_conversation, client_id, input_msg))
+
+        # Check if response is from account creation
+        if client_role == "Pending":
+            if input_msg == "yes":
+                output_msg = await run_blocking(finish_creation, client_num)
+            elif input_msg == "no":
+                output_msg = "Please input your location again. Add more specificity like street address, city, zip code, state and country."
+            else:
+                output_msg = await validate_location(client_id, input_msg)
+        # Check if response is from location update
+        elif client_role == "Updating":
+            if input_msg == "yes":
+                _, forecast = await asyncio.gather(
+                    run_blocking(update_row, client_id, "Role", "User"),
+                    get_forecast(client_curr_location, "sunset"))
+                # Reply with location update confirmation and new prediction
+                output_msg = "Your location has been updated.\n\n" + forecast
+            elif input_msg == "no":
+                output_msg = "Please input your location again. Add more specificity like street address, city, zip code, state or country."
+            else:
+                output_msg = await validate_location(client_id, input_msg)
+        else:
+
+            # Get sundown in specified location
+            if "sunset in" in input_msg or "sunset at" in input_msg or "sundown in" in input_msg or "sundown at" in input_msg:
+                location = input_msg.split(" ", 2)[2]
+                cleaned_location, output_msg = await lookup_location(location)
+                if cleaned_location is not None:
+                    output_msg = await get_forecast(cleaned_location, "sunset")
+
+            # Get sunrise in specified location
+            elif "sunrise in" in input_msg or "sunrise at" in input_msg:
+                location = input_msg.split(" ", 2)[2]
+                cleaned_location, output_msg = await lookup_location(location)
+                if cleaned_location is not None:
+                    output_msg = await get_forecast(cleaned_location, "sunrise")
+
+            # Update Location
+            elif "change location to" in input_msg or "change city to" in input_msg:
+                location = input_msg.split(" ", 3)[3]
+                _, output_msg = await asyncio.gather(
+                    run_blocking(update_row, client_id, "Role", "Updating"),
+                    validate_location(client_id, location))
+
+            # Update Location
+            elif "change to" in input_msg:
+                location = input_msg.split(" ", 2)[2]
+                _, output_msg = await asyncio.gather(
+                    run_blocking(update_row, client_id, "Role", "Updating"),
+                    validate_location(client_id, location))
+
+            # Refresh
+            elif input_msg == "refresh" or input_msg == "update" or input_msg == "sunset" or input_msg == "sundown":
+                output_msg = await get_forecast(client_curr_location, "sunset")
+
+            # Sunrise
+            elif input_msg == "sunrise":
+                output_msg = await get_forecast(client_curr_location, "sunrise")
+
+            # Get Help
+            elif input_msg == "help" or input_msg == "info":
+                await logged
+                return str(MessagingResponse())
+            else:
+                output_msg = "Sorry, we can't process your message. Reply HELP for more options."
+
+        await logged
+    else:
+        output_msg = "Sorry, we can't process your message. Reply HELP for more options."
+
+    # Update conversation dict with response
+    if client_id is not None:
+        await run_blocking(update_conversation, client_id, output_msg)
+
+    # Put it in a TwiML response
+    resp = MessagingResponse()
+    resp.message(output_msg)
+
+    return str(resp)
+
+
+if __name__ == "__main__":
+    app.run(port=5000, debug=True)
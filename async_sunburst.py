@@ -0,0 +1,186 @@
+import os
+import time
+import asyncio
+from functools import partial
+
+import httpx
+
+from cache import cache_get, cache_set
+from sunburst import (LOGIN_URL, QUALITY_URL, RETRY_STATUSES, FORECAST_TYPES,
+                      SunburstError, SunburstThrottled, TokenBucket,
+                      retry_delay, parse_forecasts, dump_forecasts,
+                      load_forecasts, sort_forecasts, select_forecast,
+                      quota_share)
+
+
+class AsyncTokenBucket(TokenBucket):
+    """TokenBucket that waits on the event loop instead of blocking it"""
+
+    async def acquire_async(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            await asyncio.sleep(wait)
+
+
+async def _run_in_default_executor(f, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(f, *args, **kwargs))
+
+
+class AsyncSunburstClient:
+    """SunburstClient for the event loop. Requests share one pooled HTTP
+        client, and identical concurrent queries share one future.
+        Shared cache calls block, so they go through RUN_BLOCKING, a
+        coroutine function that runs a call off the loop"""
+
+    def __init__(self, email, password, rate=1.0, burst=5, max_retries=4,
+                 backoff=1.0, max_backoff=30.0, max_wait=20.0, timeout=10,
+                 limit=4, forecast_ttl=900, max_connections=20,
+                 run_blocking=None):
+        self.email = email
+        self.password = password
+        self.bucket = AsyncTokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.limit = limit
+        self.forecast_ttl = forecast_ttl
+        self.http = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections))
+        self.inflight = {}
+        self.token = None
+        self.token_expires = 0
+        self.cache = {}
+        self.run_blocking = run_blocking or _run_in_default_executor
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def _coalesce(self, key, make):
+        """Await the in-flight call for key, starting one if there is none"""
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(make())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _send(self, method, url, **kwargs):
+        """Send request within the rate limit, retrying when throttled"""
+        res = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(retry_delay(
+                    attempt - 1, res, self.backoff, self.max_backoff))
+            if not await self.bucket.acquire_async(timeout=self.max_wait):
+                raise SunburstThrottled("Local Sunburst quota exhausted")
+            try:
+                res = await self.http.request(method, url, **kwargs)
+            except httpx.HTTPError:
+                res = None
+                continue
+            if res.status_code not in RETRY_STATUSES:
+                return res
+        raise SunburstThrottled("Sunburst still throttling after {} attempts".format(
+            self.max_retries + 1))
+
+    async def _login(self):
+        res = await self._send("POST", LOGIN_URL,
+                               auth=(self.email, self.password))
+        try:
+            data = res.json()
+        except ValueError:
+            raise SunburstError("Invalid Sunburst login response")
+        token = data.get("access_token") or data.get("token")
+        if not token:
+            raise SunburstError("Sunburst login failed")
+        expires_in = float(data.get("expires_in", 3600))
+        self.token = token
+        self.token_expires = time.monotonic() + max(expires_in - 60, 0)
+        return token
+
+    async def _auth_header(self, force=False):
+        if force or self.token is None or time.monotonic() >= self.token_expires:
+            await self._coalesce(("login",), self._login)
+        return {"Authorization": "Bearer " + self.token}
+
+    async def _get_quality(self, params):
+        res = await self._send("GET", QUALITY_URL, params=params,
+                               headers=await self._auth_header())
+        if res.status_code == 401:
+            res = await self._send("GET", QUALITY_URL, params=params,
+                                   headers=await self._auth_header(force=True))
+        try:
+            return res.json()
+        except ValueError:
+            raise SunburstError("Invalid Sunburst quality response")
+
+    async def quality(self, geo, **params):
+        """Get raw quality response for GEO ("lat,lng")"""
+        params["geo"] = geo
+        key = ("quality",) + tuple(sorted(params.items()))
+        return await self._coalesce(key, lambda: self._get_quality(params))
+
+    async def _fetch_forecasts(self, geo):
+        hit = await self.run_blocking(cache_get, "forecast", geo)
+        if hit is not None:
+            return load_forecasts(hit)
+
+        records = parse_forecasts(await self.quality(geo, limit=self.limit))
+        missing = [kind for kind in FORECAST_TYPES
+                   if not any(f.type == kind for f in records)]
+        responses = await asyncio.gather(
+            *[self.quality(geo, type=kind, limit=self.limit) for kind in missing])
+        for data in responses:
+            records.extend(parse_forecasts(data))
+        records = sort_forecasts(records)
+        await self.run_blocking(cache_set, "forecast", geo,
+                                dump_forecasts(records))
+        return records
+
+    async def forecasts(self, geo):
+        """Get upcoming forecast records for GEO, reusing recent results"""
+        now = time.monotonic()
+        cached = self.cache.get(geo)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        records = await self._coalesce(("forecasts", geo),
+                                       lambda: self._fetch_forecasts(geo))
+        if len(self.cache) >= 4096:
+            self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+        self.cache[geo] = (now + self.forecast_ttl, records)
+        return records
+
+    async def quality_percent(self, geo, kind="sunset"):
+        """Get the quality percent of the next KIND event at GEO"""
+        return select_forecast(await self.forecasts(geo), kind).percent
+
+
+def client_from_env(run_blocking=None):
+    """Build an async Sunburst client configured from the environment"""
+    rate, burst = quota_share()
+    return AsyncSunburstClient(
+        os.getenv("SUNBURST_EMAIL"),
+        os.getenv("SUNBURST_PW"),
+        rate=rate,
+        burst=burst,
+        max_retries=int(os.getenv("SUNBURST_MAX_RETRIES", "4")),
+        max_wait=float(os.getenv("SUNBURST_MAX_WAIT", "20")),
+        limit=int(os.getenv("SUNBURST_LIMIT", "4")),
+        forecast_ttl=float(os.getenv("SUNBURST_FORECAST_TTL", "900")),
+        run_blocking=run_blocking,
+    )
@@ -0,0 +1,186 @@
+import os
+import csv
+import json
+import uuid
+import argparse
+import datetime
+from collections import Counter
+
+import phonenumbers
+
+from flask_app import db_client, cleaned_address, send_msg, update_row
+from gazetteer import default_gazetteer
+from sunburst import TokenBucket
+
+
+# Welcome texts sent per second
+SEND_RATE = float(os.getenv("IMPORT_SEND_RATE", "1"))
+# Upstream geocoding calls per second, for locations the gazetteer can't resolve
+GEOCODE_RATE = float(os.getenv("IMPORT_GEOCODE_RATE", "1"))
+
+
+def read_rows(path):
+    """Read (phone, location) pairs from a CSV with phone/location columns
+        or a JSONL file of {"phone": ..., "location": ...} objects"""
+    # utf-8-sig drops the byte order mark Excel writes before the header
+    with open(path, encoding="utf-8-sig") as f:
+        if path.endswith((".jsonl", ".json")):
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield row.get("phone"), row.get("location")
+        else:
+            for row in csv.DictReader(f):
+                row = {k.strip().lower(): v for k, v in row.items() if k}
+                yield row.get("phone"), row.get("location")
+
+
+def normalize_phone(phone, region=None):
+    """Get phone in E.164 format, or None if it isn't a valid number"""
+    try:
+        parsed = phonenumbers.parse(phone or "", region)
+    except phonenumbers.NumberParseException:
+        return None
+    if not phonenumbers.is_valid_number(parsed):
+        return None
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+
+
+def existing_clients():
+    """Get every subscriber keyed by phone number with one projected scan,
+        with what's needed to finish an earlier import's welcome"""
+    table = db_client()
+    kwargs = {"ProjectionExpression": "#I, #P, #L, #M, #W",
+              "ExpressionAttributeNames": {"#I": "Id", "#P": "Phone",
+                                           "#L": "Location", "#M": "Imported",
+                                           "#W": "Welcomed"}}
+    response = table.scan(**kwargs)
+    items = response["Items"]
+    while "LastEvaluatedKey" in response:
+        response = table.scan(
+            ExclusiveStartKey=response["LastEvaluatedKey"], **kwargs)
+        items.extend(response["Items"])
+    return {item["Phone"]: item for item in items if item.get("Phone")}
+
+
+def resolve_locations(locations):
+    """Clean each distinct location once. Unresolvable ones map to None"""
+    gazetteer = default_gazetteer()
+    limiter = TokenBucket(GEOCODE_RATE, 1)
+    resolved = {}
+    for location in locations:
+        place = gazetteer and gazetteer.lookup(location)
+        if place:
+            resolved[location] = place[1]
+            continue
+        limiter.acquire()
+        try:
+            cleaned = cleaned_address(location)
+        except Exception:
+            cleaned = -1
+        resolved[location] = None if cleaned == -1 else cleaned
+    return resolved
+
+
+def welcome(item, limiter):
+    """Send welcome texts to an imported subscriber, pacing each one, then
+        record that they were welcomed"""
+    location = item.get("Location")
+    msgs = ["Welcome to Sundown, the simple way to get daily notifications of the sunset quality."]
+    if location:
+        msgs.append("You will now receive daily sunset texts for " + location +
+                    ". Reply SUNDOWN to get your first sunset quality text.\n\nReply HELP for more options.")
+    else:
+        msgs.append("To begin, please respond with your location. You can reply with a street address, city and state or zipcode.")
+    for msg in msgs:
+        limiter.acquire()
+        # The item was only just written, so log under its known Id rather
+        # than look it up on the Phone index, which may not have it yet
+        send_msg(item["Phone"], msg, item["Id"])
+    update_row(item["Id"], "Welcomed", str(datetime.datetime.now()))
+
+
+def bulk_import(path, region=None, send_welcome=True, dry_run=False):
+    """Import subscribers from path. Returns a summary Counter"""
+    summary = Counter()
+
+    # Validate and dedupe within the file
+    subscribers = {}
+    for phone, location in read_rows(path):
+        summary["rows"] += 1
+        number = normalize_phone(phone, region)
+        if number is None:
+            summary["invalid"] += 1
+            print("Invalid number: {}".format(phone))
+        elif number in subscribers:
+            summary["duplicate"] += 1
+        else:
+            subscribers[number] = (location or "").strip()
+
+    # Dedupe against the table in one pass, however numbers were stored.
+    # Subscribers an earlier run imported but didn't welcome get welcomed
+    existing = {normalize_phone(phone) or phone: item
+                for phone, item in existing_clients().items()}
+    unwelcomed = []
+    for number in [n for n in subscribers if n in existing]:
+        del subscribers[number]
+        item = existing[number]
+        if item.get("Imported") and not item.get("Welcomed"):
+            unwelcomed.append(item)
+        else:
+            summary["existing"] += 1
+
+    resolved = resolve_locations(sorted(set(
+        location for location in subscribers.values() if location)))
+
+    # Located subscribers are ready to go, the rest finish onboarding by text
+    now = str(datetime.datetime.now())
+    items = []
+    for number, location in subscribers.items():
+        cleaned = resolved.get(location)
+        item = {"Id": str(uuid.uuid4()), "Phone": number,
+                "Role": "User" if cleaned else "Pending",
+                "Location": cleaned or "", "Imported": now}
+        if cleaned:
+            item["Account Created"] = now
+        else:
+            summary["unlocated"] += 1
+        items.append(item)
+
+    if dry_run:
+        summary["would_import"] = len(items)
+        summary["would_rewelcome"] = len(unwelcomed)
+        return summary
+
+    with db_client().batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+    summary["imported"] = len(items)
+
+    if send_welcome:
+        limiter = TokenBucket(SEND_RATE, 1)
+        for item in unwelcomed + items:
+            try:
+                welcome(item, limiter)
+                summary["welcomed"] += 1
+            except Exception as e:
+                summary["welcome_failed"] += 1
+                print("Failed to welcome {}: {}".format(item["Phone"], e))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import subscribers from a CSV (phone,location) or JSONL file")
+    parser.add_argument("path")
+    parser.add_argument("--region", default=None,
+                        help="default region for numbers without a country code, e.g. US")
+    parser.add_argument("--no-welcome", action="store_true",
+                        help="don't text imported subscribers")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="validate and geocode without writing or texting")
+    args = parser.parse_args()
+
+    summary = bulk_import(args.path, args.region,
+                          not args.no_welcome, args.dry_run)
+    print("Import summary: {}".format(dict(summary)))
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from functools import wraps
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# Seconds each kind of result stays cached, overridable with CACHE_TTL_<KIND>
+DEFAULT_TTLS = {
+    "geocode": 30 * 24 * 3600,
+    "address": 30 * 24 * 3600,
+    "timezone": 90 * 24 * 3600,
+    "forecast": 15 * 60,
+}
+# Lookups that found nothing are retried sooner
+NEGATIVE_TTL = int(os.getenv("CACHE_NEGATIVE_TTL", "3600"))
+
+
+def ttl_for(kind):
+    """Get TTL in seconds for a kind of cached data"""
+    return int(os.getenv("CACHE_TTL_" + kind.upper(), DEFAULT_TTLS.get(kind, 3600)))
+
+
+def _default_sqlite_path():
+    # Prefer tmpfs so the cache lives in shared memory
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "sundown-cache.db")
+
+
+#  ================== Backends ==================
+
+
+class NullCache:
+    """Cache that stores nothing"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+
+class SQLiteCache:
+    """Cache shared by every process on the host through one SQLite file"""
+
+    def __init__(self, path=None):
+        self.path = path or _default_sqlite_path()
+        self.local = threading.local()
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires REAL NOT NULL
+            )""")
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?",
+            (key, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key, value, ttl):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                     (key, value, time.time() + ttl))
+        # Purge expired rows now and then instead of on every write
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+
+
+class RedisCache:
+    """Cache shared through any Redis-protocol server"""
+
+    def __init__(self, url):
+        if redis is None:
+            raise ImportError("RedisCache requires the redis package")
+        self.client = redis.Redis.from_url(url, socket_timeout=1)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else value.decode("utf-8")
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=int(ttl))
+
+
+def make_cache(url=None):
+    """Build cache backend from URL (CACHE_URL): redis://..., rediss://...,
+        sqlite:///path, or none"""
+    url = url if url is not None else os.getenv("CACHE_URL", "sqlite://")
+    if url == "none":
+        return NullCache()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url)
+    if url.startswith("sqlite://"):
+        return SQLiteCache(url[len("sqlite://"):] or None)
+    raise ValueError("Unknown CACHE_URL: " + url)
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """Get the shared cache configured from the environment"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            try:
+                _default_cache = make_cache()
+            except Exception as e:
+                print("Cache disabled: {}".format(e))
+                _default_cache = NullCache()
+        return _default_cache
+
+
+#  ================== Helpers ==================
+
+
+def cache_get(kind, key):
+    """Get cached JSON value, or None on a miss or backend failure"""
+    try:
+        raw = default_cache().get(kind + ":" + key)
+    except Exception:
+        return None
+    if raw is None:
+        return None
+    return json.loads(raw)
+
+
+def cache_set(kind, key, value, ttl=None):
+    """Store JSON-serialisable value, ignoring backend failures"""
+    try:
+        default_cache().set(kind + ":" + key, json.dumps(value),
+                            ttl_for(kind) if ttl is None else ttl)
+    except Exception:
+        pass
+
+
+def _restore(value):
+    # JSON turns tuples into lists
+    return tuple(value) if isinstance(value, list) else value
+
+
+def cached(kind):
+    """Cache a single-argument lookup in the shared cache under KIND.
+        The wrapper's peek(arg) gets the cached value without calling f"""
+    def decorator(f):
+        def cache_key(arg):
+            # Geocoding ignores case and surrounding whitespace
+            if isinstance(arg, str):
+                return json.dumps(arg.strip().lower())
+            return json.dumps(arg)
+
+        def peek(arg):
+            hit = cache_get(kind, cache_key(arg))
+            return None if hit is None else _restore(hit["v"])
+
+        @wraps(f)
+        def decorated_function(arg):
+            key = cache_key(arg)
+            hit = cache_get(kind, key)
+            if hit is not None:
+                return _restore(hit["v"])
+            value = f(arg)
+            ttl = NEGATIVE_TTL if value in (-1, None) else None
+            cache_set(kind, key, {"v": value}, ttl)
+            return value
+        decorated_function.peek = peek
+        return decorated_function
+    return decorator
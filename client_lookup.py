@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+
+# Global secondary index with Phone as its partition key, see the README
+PHONE_INDEX = os.getenv("PHONE_INDEX", "Phone-index")
+CACHE_SIZE = int(os.getenv("CLIENT_CACHE_SIZE", "1024"))
+# Keep entries short-lived so workers that didn't make a change see it soon
+CACHE_TTL = float(os.getenv("CLIENT_CACHE_TTL", "10"))
+# Fields that decide how a text is handled; other writes keep cache entries
+ROUTING_FIELDS = ("Role", "Location")
+
+
+class ClientLookupError(Exception):
+    """Raised when clients can't be looked up by phone"""
+
+
+class LRUCache:
+    """Thread-safe LRU cache whose entries expire after TTL seconds"""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Drop every entry whose value matches predicate"""
+        with self.lock:
+            for key in [k for k, (_, v) in self.items.items() if predicate(v)]:
+                del self.items[key]
+
+    def replace_where(self, predicate, update):
+        """Replace every value matching predicate with update(value),
+            keeping its expiry"""
+        with self.lock:
+            for key, (expires, value) in list(self.items.items()):
+                if predicate(value):
+                    self.items[key] = (expires, update(value))
+
+
+_MISSING = object()
+
+
+class ClientLookup:
+    """Find clients by phone number with a keyed query on the Phone global
+        secondary index, fronted by a small per-worker LRU"""
+
+    def __init__(self, table_factory, index_name=PHONE_INDEX, cache=None):
+        self.table_factory = table_factory
+        self.index_name = index_name
+        self.cache = cache if cache is not None else LRUCache()
+
+    def get(self, phone_number):
+        """Get client item for phone number, or None"""
+        if not phone_number:
+            return None
+        client = self.cache.get(phone_number, _MISSING)
+        if client is not _MISSING:
+            return client
+
+        try:
+            response = self.table_factory().query(
+                IndexName=self.index_name,
+                KeyConditionExpression=Key("Phone").eq(phone_number),
+                # Only what routing needs, not the growing Conversation
+                ProjectionExpression="#I, #P, #R, #L",
+                ExpressionAttributeNames={"#I": "Id", "#P": "Phone",
+                                          "#R": "Role", "#L": "Location"},
+                Limit=1,
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "ValidationException":
+                raise ClientLookupError(
+                    "Can't query index {!r} on Phone, create it or set "
+                    "PHONE_INDEX (see README): {}".format(self.index_name, e))
+            raise
+        items = response.get("Items", [])
+        client = items[0] if items else None
+        self.cache.set(phone_number, client)
+        return client
+
+    def updated(self, client_id, key, value):
+        """Apply this worker's write of KEY to cached entries. Only routing
+            fields are cached, so other writes leave them alone. The index
+            may lag behind the write, so entries are updated in place
+            rather than dropped and queried again"""
+        if key not in ROUTING_FIELDS:
+            return
+        self.cache.replace_where(
+            lambda client: client is not None and client.get("Id") == client_id,
+            lambda client: dict(client, **{key: value}))
+
+    def invalidate(self, phone_number=None, client_id=None):
+        """Forget cached entries after this worker changes a client"""
+        if phone_number is not None:
+            self.cache.delete(phone_number)
+        if client_id is not None:
+            self.cache.delete_where(
+                lambda client: client is not None and client.get("Id") == client_id)
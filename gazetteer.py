@@ -0,0 +1,345 @@
+import os
+import re
+import sys
+import mmap
+import math
+import struct
+import difflib
+import threading
+
+
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.idx"))
+# Only trust an offline timezone when a known place is this close
+MAX_TIMEZONE_KM = float(os.getenv("GAZETTEER_TIMEZONE_KM", "50"))
+# Similarity needed for a fuzzy name match
+FUZZY_CUTOFF = float(os.getenv("GAZETTEER_FUZZY_CUTOFF", "0.85"))
+# Fuzzy matches must share this many leading characters, and give up
+# rather than scan more candidate keys than this
+FUZZY_PREFIX = 3
+MAX_FUZZY_SCAN = 3000
+
+EARTH_KM = 6371.0
+
+MAGIC = b"SDGZ"
+VERSION = 2
+# magic, version, record count, key count, records/keys/strings offsets
+HEADER = struct.Struct("<4sHIIIII")
+# unit vector x, y, z, label offset, timezone offset, kind
+RECORD = struct.Struct("<fffIIB")
+# Kinds of place, best match first
+CITY, TOWN, POSTAL = 0, 1, 2
+# key offset, record index
+KEY = struct.Struct("<II")
+
+
+def normalize(text):
+    """Normalize user input into a gazetteer key"""
+    text = text.lower().strip()
+    text = re.sub(r"[^\w, ]", " ", text)
+    text = re.sub(r"\s*,\s*", ", ", text)
+    text = re.sub(r"\s+", " ", text).strip(" ,")
+    # ZIP+4 resolves to its ZIP code
+    match = re.fullmatch(r"(\d{5}) ?\d{4}", text)
+    if match:
+        return match.group(1)
+    return text
+
+
+def _to_vector(lat, lng):
+    lat, lng = math.radians(lat), math.radians(lng)
+    return (math.cos(lat) * math.cos(lng),
+            math.cos(lat) * math.sin(lng),
+            math.sin(lat))
+
+
+def _to_coord(x, y, z):
+    return (math.degrees(math.asin(max(-1.0, min(1.0, z)))),
+            math.degrees(math.atan2(y, x)))
+
+
+def _chord_km(km):
+    """Straight-line distance between unit vectors KM apart on the surface"""
+    return 2 * math.sin(min(km / EARTH_KM, math.pi) / 2)
+
+
+#  ================== Building ==================
+
+
+def _kd_order(points, lo, hi, depth, out):
+    """Lay points out so every range's middle element splits it on one axis"""
+    if lo >= hi:
+        return
+    axis = depth % 3
+    points[lo:hi] = sorted(points[lo:hi], key=lambda p: p[0][axis])
+    mid = (lo + hi) // 2
+    out[mid] = points[mid]
+    _kd_order(points, lo, mid, depth + 1, out)
+    _kd_order(points, mid + 1, hi, depth + 1, out)
+
+
+def read_places(postal_path=None, cities_path=None):
+    """Read GeoNames postal code and cities dumps into
+        (lat, lng, label, timezone, keys, kind) tuples"""
+    places = []
+    if cities_path:
+        with open(cities_path, encoding="utf-8") as f:
+            for line in f:
+                row = line.rstrip("\n").split("\t")
+                if len(row) < 18:
+                    continue
+                name, country, admin1 = row[1], row[8], row[10]
+                # Codes like CA or NSW mean something to users, numeric
+                # ones like France's 11 don't
+                if admin1.isalpha():
+                    label = "{}, {}, {}".format(name, admin1, country)
+                else:
+                    label = "{}, {}".format(name, country)
+                keys = {name, row[2], "{}, {}".format(name, admin1),
+                        "{}, {}".format(row[2], admin1),
+                        "{}, {}".format(name, country)}
+                places.append((float(row[4]), float(row[5]), label, row[17],
+                               keys, CITY))
+    if postal_path:
+        # Towns get one record at the centre of all their postal codes
+        towns = {}
+        with open(postal_path, encoding="utf-8") as f:
+            for line in f:
+                row = line.rstrip("\n").split("\t")
+                if len(row) < 11 or not row[9] or not row[10]:
+                    continue
+                country, code, name, state, state_code = row[:5]
+                lat, lng = float(row[9]), float(row[10])
+                state_code = state_code or state
+                label = "{}, {} {}, {}".format(name, state_code, code, country)
+                keys = {code, "{} {}".format(country, code)}
+                places.append((lat, lng, label, "", keys, POSTAL))
+                town = towns.setdefault((name, state_code, country),
+                                        [0.0, 0.0, 0, {state}])
+                town[0] += lat
+                town[1] += lng
+                town[2] += 1
+                town[3].add(state)
+        for (name, state_code, country), (lat, lng, n, states) in towns.items():
+            label = "{}, {}, {}".format(name, state_code, country)
+            keys = {"{}, {}".format(name, state_code), name}
+            keys.update("{}, {}".format(name, state) for state in states)
+            places.append((lat / n, lng / n, label, "", keys, TOWN))
+    return places
+
+
+def build(places, out_path):
+    """Write places to a memory-mappable index at out_path"""
+    strings = bytearray()
+    offsets = {}
+
+    def intern(text):
+        if text not in offsets:
+            offsets[text] = len(strings)
+            strings.extend(text.encode("utf-8") + b"\0")
+        return offsets[text]
+
+    points = [(_to_vector(place[0], place[1]), i)
+              for i, place in enumerate(places)]
+    ordered = [None] * len(points)
+    _kd_order(points, 0, len(points), 0, ordered)
+
+    records = bytearray()
+    keys = []
+    for index, (vector, i) in enumerate(ordered):
+        # Postal codes and towns carry no timezone of their own
+        lat, lng, label, timezone, place_keys, kind = places[i]
+        records.extend(RECORD.pack(vector[0], vector[1], vector[2],
+                                   intern(label), intern(timezone), kind))
+        # Labels are stored as subscriber locations, so they resolve too
+        for key in place_keys | {label}:
+            key = normalize(key)
+            if key:
+                keys.append((key, index))
+
+    keys.sort()
+    key_table = bytearray()
+    for key, index in keys:
+        key_table.extend(KEY.pack(intern(key), index))
+
+    records_off = HEADER.size
+    keys_off = records_off + len(records)
+    strings_off = keys_off + len(key_table)
+    with open(out_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(ordered), len(keys),
+                            records_off, keys_off, strings_off))
+        f.write(records)
+        f.write(key_table)
+        f.write(strings)
+
+
+#  ================== Lookup ==================
+
+
+def _nearest(count, target, vector_at, lo=0, hi=None, depth=0,
+             best=(float("inf"), -1), accept=None):
+    """Nearest neighbour search over an implicit k-d tree of COUNT points,
+        only counting indexes ACCEPT allows. Nothing farther than BEST's
+        squared distance is considered.
+        Returns (squared chord distance, index)"""
+    if hi is None:
+        hi = count
+    if lo >= hi:
+        return best
+    mid = (lo + hi) // 2
+    point = vector_at(mid)
+    dist = sum((a - b) ** 2 for a, b in zip(point, target))
+    if dist < best[0] and (accept is None or accept(mid)):
+        best = (dist, mid)
+    axis = depth % 3
+    diff = target[axis] - point[axis]
+    near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else (
+        (mid + 1, hi), (lo, mid))
+    best = _nearest(count, target, vector_at,
+                    near[0], near[1], depth + 1, best, accept)
+    if diff * diff < best[0]:
+        best = _nearest(count, target, vector_at,
+                        far[0], far[1], depth + 1, best, accept)
+    return best
+
+
+class Gazetteer:
+    """Offline geocoder over a memory-mapped gazetteer index"""
+
+    def __init__(self, path=GAZETTEER_PATH):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, self.key_count, self.records_off,
+         self.keys_off, self.strings_off) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a gazetteer index: " + path)
+
+    def _record(self, index):
+        return RECORD.unpack_from(self.data, self.records_off + index * RECORD.size)
+
+    def _string(self, offset):
+        start = self.strings_off + offset
+        return self.data[start:self.data.find(b"\0", start)].decode("utf-8")
+
+    def _key(self, position):
+        key_off, index = KEY.unpack_from(
+            self.data, self.keys_off + position * KEY.size)
+        return self._string(key_off), index
+
+    def _bisect(self, key):
+        lo, hi = 0, self.key_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _exact(self, key):
+        """Get record indexes stored under key"""
+        matches = []
+        position = self._bisect(key)
+        while position < self.key_count:
+            found, index = self._key(position)
+            if found != key:
+                break
+            matches.append(index)
+            position += 1
+        return matches
+
+    def _fuzzy(self, key):
+        """Find the closest key sharing key's first FUZZY_PREFIX characters.
+            Street addresses skip the search, they only resolve upstream"""
+        if len(key) <= FUZZY_PREFIX or re.match(r"\d+\w*\s", key) or key.count(",") > 2:
+            return None
+        prefix = key[:FUZZY_PREFIX]
+        # Keys whose length differs by more than this can't reach the cutoff
+        spread = len(key) * (2 / FUZZY_CUTOFF - 2)
+        candidates = set()
+        position = self._bisect(prefix)
+        end = min(position + MAX_FUZZY_SCAN, self.key_count)
+        while position < end:
+            found, _ = self._key(position)
+            if not found.startswith(prefix):
+                break
+            if abs(len(found) - len(key)) <= spread:
+                candidates.add(found)
+            position += 1
+        else:
+            if position < self.key_count and self._key(position)[0].startswith(prefix):
+                # Too common a prefix to search quickly
+                return None
+        close = difflib.get_close_matches(key, candidates, 1, FUZZY_CUTOFF)
+        return close[0] if close else None
+
+    def _place(self, index):
+        x, y, z, label_off, _, _ = self._record(index)
+        return _to_coord(x, y, z), self._string(label_off)
+
+    def lookup(self, address):
+        """Get ((lat, lng), label) for a ZIP code or city name, or None if
+            the input is unknown or matches more than one place"""
+        key = normalize(address)
+        if not key:
+            return None
+        matches = self._exact(key)
+        if not matches and not key.isdigit():
+            close = self._fuzzy(key)
+            if close is not None:
+                matches = self._exact(close)
+        if not matches:
+            return None
+        # Prefer cities over towns over postal codes, then require a
+        # single place so ambiguous names fall through to Nominatim
+        best = min(self._record(i)[5] for i in matches)
+        places = {}
+        for i in matches:
+            if self._record(i)[5] == best:
+                coords, label = self._place(i)
+                places[label] = coords
+        if len(places) != 1:
+            return None
+        label, coords = places.popitem()
+        return coords, label
+
+    def nearest_timezone(self, coords, max_km=MAX_TIMEZONE_KM):
+        """Get timezone of the nearest city to coords, or None if no city
+            is within max_km. Only cities have a GeoNames timezone"""
+        target = _to_vector(coords[0], coords[1])
+        _, index = _nearest(
+            self.count, target, lambda i: self._record(i)[:3],
+            best=(_chord_km(max_km) ** 2, -1),
+            accept=lambda i: self._record(i)[5] == CITY)
+        if index < 0:
+            return None
+        return self._string(self._record(index)[4]) or None
+
+
+_default_gazetteer = None
+_default_lock = threading.Lock()
+
+
+def default_gazetteer():
+    """Get the bundled gazetteer, or None if no index is installed"""
+    global _default_gazetteer
+    with _default_lock:
+        if _default_gazetteer is None:
+            try:
+                _default_gazetteer = Gazetteer()
+            except (OSError, ValueError):
+                _default_gazetteer = False
+        return _default_gazetteer or None
+
+
+if __name__ == "__main__":
+    # python gazetteer.py <postal codes.txt> <cities.txt> [out.idx]
+    # Inputs are GeoNames dumps, e.g. export/zip/US.txt and cities15000.txt
+    if len(sys.argv) < 3:
+        print("Usage: python gazetteer.py POSTAL_TXT CITIES_TXT [OUT_IDX]")
+        sys.exit(1)
+    out = sys.argv[3] if len(sys.argv) > 3 else GAZETTEER_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    places = read_places(sys.argv[1], sys.argv[2])
+    build(places, out)
+    print("Wrote {} places to {}".format(len(places), out))
@@ -0,0 +1,192 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from geopy.geocoders import Nominatim, GeoNames
+
+
+# Whole-call deadline, in seconds
+DEADLINE = float(os.getenv("GEOCODE_DEADLINE", "5"))
+# Ask the next provider if the first hasn't answered after this many seconds
+HEDGE_AFTER = float(os.getenv("GEOCODE_HEDGE_AFTER", "0.8"))
+# Consecutive failures that open a provider's circuit, and for how long
+BREAKER_FAILURES = int(os.getenv("GEOCODE_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("GEOCODE_BREAKER_COOLDOWN", "60"))
+
+
+class GeocodeError(Exception):
+    """Raised when no provider answers before the deadline"""
+
+
+#  ================== Circuit Breaker ==================
+
+
+class CircuitBreaker:
+    """Stop calling a provider after repeated failures, then let a single
+        trial call through once the cooldown has passed"""
+
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.trial or time.monotonic() - self.opened_at >= self.cooldown:
+                return "half-open"
+            return "open"
+
+
+#  ================== Latency Stats ==================
+
+
+class LatencyStats:
+    """Call counts and recent latency percentiles for a provider"""
+
+    def __init__(self, window=512):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, seconds, ok):
+        with self.lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self.samples.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            calls, errors = self.calls, self.errors
+
+        def percentile(p):
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1)
+
+        return {"calls": calls, "errors": errors, "p50_ms": percentile(.5),
+                "p95_ms": percentile(.95), "p99_ms": percentile(.99)}
+
+
+#  ================== Geocoder ==================
+
+
+class Provider:
+    """A geopy geocoder with its own breaker and latency stats"""
+
+    def __init__(self, name, geolocator):
+        self.name = name
+        self.geolocator = geolocator
+        self.breaker = CircuitBreaker()
+        self.stats = LatencyStats()
+
+    def geocode(self, query, timeout):
+        start = time.monotonic()
+        try:
+            location = self.geolocator.geocode(query, timeout=timeout)
+        except Exception:
+            self.stats.record(time.monotonic() - start, False)
+            self.breaker.failure()
+            raise
+        self.stats.record(time.monotonic() - start, True)
+        self.breaker.success()
+        return location
+
+
+class HedgedGeocoder:
+    """Geocode with a deadline, hedging to the next provider when the
+        current one is slow and skipping providers whose circuit is open"""
+
+    def __init__(self, providers, deadline=DEADLINE, hedge_after=HEDGE_AFTER):
+        self.providers = providers
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("GEOCODE_WORKERS", "8")),
+            thread_name_prefix="geocode")
+
+    def geocode(self, query):
+        """Get geopy Location for query, or None if it can't be found"""
+        end = time.monotonic() + self.deadline
+        waiting = list(self.providers)
+        pending = set()
+        hedge_at = 0
+        while True:
+            while waiting and (not pending or time.monotonic() >= hedge_at):
+                provider = waiting.pop(0)
+                # Ask the breaker only when calling, so a half-open
+                # provider's trial slot isn't taken by a call never sent
+                if provider.breaker.allow():
+                    pending.add(self.executor.submit(
+                        provider.geocode, query, max(end - time.monotonic(), 0.1)))
+                    hedge_at = time.monotonic() + self.hedge_after
+            if not pending:
+                raise GeocodeError("No geocoding provider answered")
+
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise GeocodeError("Geocoding timed out")
+            timeout = min(remaining, hedge_at - time.monotonic()
+                          ) if waiting else remaining
+            done, pending = wait(pending, timeout=max(timeout, 0),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            # Failed providers hand over to the next one immediately
+            if done:
+                hedge_at = time.monotonic()
+
+    def stats(self):
+        """Get per-provider latency stats and circuit state"""
+        return {p.name: dict(p.stats.snapshot(), circuit=p.breaker.state)
+                for p in self.providers}
+
+
+_default_geocoder = None
+_default_lock = threading.Lock()
+
+
+def default_geocoder():
+    """Get the shared geocoder: Nominatim first, then GeoNames"""
+    global _default_geocoder
+    with _default_lock:
+        if _default_geocoder is None:
+            providers = [Provider("nominatim", Nominatim(user_agent="sundown"))]
+            if os.getenv("GEONAMES_USERNAME"):
+                providers.append(Provider("geonames", GeoNames(
+                    username=os.getenv("GEONAMES_USERNAME"))))
+            _default_geocoder = HedgedGeocoder(providers)
+        return _default_geocoder
@@ -0,0 +1,92 @@
+import os
+import sys
+import glob
+import pstats
+import argparse
+
+from profiling import PROFILE_DIR
+
+
+# Stop descending past this depth, recursion is cut at the first repeat
+MAX_DEPTH = 64
+
+
+def frame_name(func):
+    """Format a pstats function key as a flame graph frame"""
+    filename, line, name = func
+    if filename == "~":
+        # Built-in functions
+        return name.replace(";", ":")
+    return "{} ({}:{})".format(name, os.path.basename(filename), line).replace(";", ":")
+
+
+def collapse(stats):
+    """Turn merged pstats into {"a;b;c": microseconds} collapsed stacks.
+
+        pstats only keeps caller/callee pairs, so each function's time is
+        split across its callers in proportion to the time spent in it
+        from each one."""
+    children = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            children.setdefault(caller, []).append((func, edge[3]))
+
+    stacks = {}
+
+    def walk(func, share, path):
+        tt = stats.stats[func][2]
+        path = path + [frame_name(func)]
+        if tt * share > 0:
+            key = ";".join(path)
+            stacks[key] = stacks.get(key, 0) + tt * share
+        if len(path) >= MAX_DEPTH:
+            return
+        for child, edge_ct in children.get(func, []):
+            child_ct = stats.stats[child][3]
+            # Skip recursion and paths too small to show up
+            if child == func or frame_name(child) in path or share * edge_ct < 1e-6:
+                continue
+            walk(child, share * edge_ct / child_ct, path)
+
+    roots = [func for func, (_, _, _, _, callers) in stats.stats.items()
+             if not callers]
+    for root in roots:
+        walk(root, 1.0, [])
+    return {k: int(round(v * 1e6)) for k, v in stacks.items() if v * 1e6 >= 1}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Merge profile dumps into collapsed stacks for flamegraph.pl or speedscope")
+    parser.add_argument("label", nargs="?", default="",
+                        help="only merge profiles whose label contains this, e.g. incoming_text-sunset")
+    parser.add_argument("-d", "--dir", default=PROFILE_DIR,
+                        help="directory of .prof files")
+    parser.add_argument("-o", "--output", help="write here instead of stdout")
+    parser.add_argument("--pstats", help="also save the merged pstats file here")
+    args = parser.parse_args(argv)
+
+    paths = sorted(p for p in glob.glob(os.path.join(args.dir, "*.prof"))
+                   if args.label in os.path.basename(p))
+    if not paths:
+        print("No profiles found", file=sys.stderr)
+        return 1
+
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+    if args.pstats:
+        stats.dump_stats(args.pstats)
+
+    lines = ["{} {}".format(stack, value) for stack, value
+             in sorted(collapse(stats).items())]
+    out = open(args.output, "w") if args.output else sys.stdout
+    out.write("\n".join(lines) + "\n")
+    if args.output:
+        out.close()
+    print("Merged {} profiles".format(len(paths)), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
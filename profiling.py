@@ -0,0 +1,162 @@
+import os
+import re
+import hmac
+import time
+import random
+import hashlib
+import cProfile
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from flask import request
+
+try:
+    from quart import request as async_request
+except ImportError:
+    async_request = None
+
+
+# Fraction of requests and send iterations to profile, 0 disables sampling
+PROFILE_RATE = float(os.getenv("PROFILE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "profiles"))
+# Oldest profiles are deleted beyond this many, 0 keeps them all
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "500"))
+# Requests carrying a valid signature in this header are always profiled
+PROFILE_HEADER = "X-Sundown-Profile"
+PROFILE_SECRET = os.getenv("PROFILE_SECRET")
+# Signed headers are only accepted for this many seconds
+SIGNATURE_TTL = 300
+# SMS commands used in profile labels; anything else may be personal data
+COMMANDS = {"sunset", "sundown", "sunrise", "refresh", "update", "change",
+            "help", "info", "yes", "no"}
+
+
+def sign(path, timestamp=None, secret=None):
+    """Make PROFILE_HEADER value that asks for PATH to be profiled"""
+    timestamp = str(int(time.time() if timestamp is None else timestamp))
+    secret = secret or PROFILE_SECRET
+    digest = hmac.new(secret.encode("utf-8"),
+                      "{}:{}".format(timestamp, path).encode("utf-8"),
+                      hashlib.sha256).hexdigest()
+    return timestamp + ":" + digest
+
+
+def valid_signature(header, path):
+    """Check a PROFILE_HEADER value is signed with PROFILE_SECRET and fresh"""
+    if not header or not PROFILE_SECRET:
+        return False
+    timestamp, _, _ = header.partition(":")
+    try:
+        age = time.time() - int(timestamp)
+    except ValueError:
+        return False
+    if not 0 <= age <= SIGNATURE_TTL:
+        return False
+    return hmac.compare_digest(header, sign(path, timestamp))
+
+
+def should_profile(header=None, path=""):
+    """Decide whether to profile: a signed request or a sampled one"""
+    if valid_signature(header, path):
+        return True
+    return PROFILE_RATE > 0 and random.random() < PROFILE_RATE
+
+
+@contextmanager
+def profiled(label, enabled=True):
+    """Profile the block and write PROFILE_DIR/<time>-<label>-<pid>.prof"""
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profile is already running in this process
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = "{}-{}-{}.prof".format(
+            int(time.time() * 1000), re.sub(r"[^\w.-]+", "_", label), os.getpid())
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+        prune_profiles()
+
+
+def prune_profiles(directory=None, keep=None):
+    """Delete the oldest profiles in directory so at most KEEP remain"""
+    directory = directory or PROFILE_DIR
+    keep = PROFILE_MAX_FILES if keep is None else keep
+    if keep <= 0:
+        return
+    paths = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".prof"):
+            try:
+                paths.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                # Pruned by another process meanwhile
+                continue
+    paths.sort()
+    for _, path in paths[:max(0, len(paths) - keep)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def command_label(body):
+    """Get the SMS command to label a profile with"""
+    words = (body or "").replace("+", " ").strip().lower().split()
+    if not words:
+        return None
+    return words[0] if words[0] in COMMANDS else "text"
+
+
+def profile_request(f):
+    """Profile sampled or signed requests, labelled by route and command"""
+    @ wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not should_profile(request.headers.get(PROFILE_HEADER), request.path):
+            return f(*args, **kwargs)
+        label = f.__name__
+        command = command_label(request.values.get("Body"))
+        if command:
+            label += "-" + command
+        with profiled(label):
+            return f(*args, **kwargs)
+    return decorated_function
+
+
+# The event loop runs requests on one thread, so only one is profiled at a
+# time; cProfile would otherwise mix or drop concurrent profiles
+_async_profiling = threading.Lock()
+
+
+def profile_async_request(f):
+    """Async profile_request for the Quart app. The profile covers the
+        event loop thread while the request is in flight, so it also holds
+        whatever ran between its awaits, and not the blocking calls it
+        hands to the thread pool"""
+    @ wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not should_profile(async_request.headers.get(PROFILE_HEADER),
+                              async_request.path):
+            return await f(*args, **kwargs)
+        if not _async_profiling.acquire(blocking=False):
+            return await f(*args, **kwargs)
+        try:
+            label = f.__name__
+            command = command_label((await async_request.values).get("Body"))
+            if command:
+                label += "-" + command
+            with profiled(label):
+                return await f(*args, **kwargs)
+        finally:
+            _async_profiling.release()
+    return decorated_function
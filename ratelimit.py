@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+from collections import deque, Counter
+
+
+# Set when a proxy in front of the app sets X-Real-IP; otherwise the
+# header is client-controlled and ignored
+TRUST_PROXY = os.getenv("TRUST_PROXY") == "1"
+
+
+def client_ip(headers, remote_addr):
+    """Get the client IP, from X-Real-IP only behind a trusted proxy"""
+    if TRUST_PROXY:
+        return headers.get("X-Real-IP") or remote_addr
+    return remote_addr
+
+
+class SlidingWindowLimiter:
+    """Allow at most LIMIT hits per key in any WINDOW seconds"""
+
+    def __init__(self, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.hits = {}
+
+    def allow(self, key):
+        now = time.monotonic()
+        cutoff = now - self.window
+        with self.lock:
+            hits = self.hits.get(key)
+            if hits is None:
+                if len(self.hits) >= self.max_keys:
+                    self._prune(cutoff)
+                hits = self.hits[key] = deque()
+            while hits and hits[0] <= cutoff:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return False
+            hits.append(now)
+            return True
+
+    def _prune(self, cutoff):
+        """Forget keys with no recent hits, or the oldest keys if all are busy"""
+        for key in [k for k, h in self.hits.items() if not h or h[-1] <= cutoff]:
+            del self.hits[key]
+        while len(self.hits) >= self.max_keys:
+            del self.hits[next(iter(self.hits))]
+
+
+class AdmissionQueue:
+    """Run at most MAX_ACTIVE requests at once with at most MAX_QUEUED
+        waiting; anything beyond that is turned away immediately"""
+
+    def __init__(self, max_active, max_queued, max_wait):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.active = 0
+        self.queued = 0
+
+    def enter(self, wait=True):
+        """Take a slot, waiting in the queue if allowed. Return False if
+            the request should be rejected"""
+        with self.cond:
+            if self.active < self.max_active:
+                self.active += 1
+                return True
+            if not wait or self.queued >= self.max_queued:
+                return False
+            self.queued += 1
+            try:
+                admitted = self.cond.wait_for(
+                    lambda: self.active < self.max_active, self.max_wait)
+            finally:
+                self.queued -= 1
+            if admitted:
+                self.active += 1
+            return admitted
+
+    def leave(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+
+class CreateLimiter:
+    """Admission control for account creation: per-IP and per-phone
+        sliding windows in front of a bounded admission queue"""
+
+    def __init__(self):
+        self.by_ip = SlidingWindowLimiter(
+            int(os.getenv("CREATE_LIMIT_PER_IP", "5")),
+            float(os.getenv("CREATE_LIMIT_IP_WINDOW", "600")))
+        self.by_phone = SlidingWindowLimiter(
+            int(os.getenv("CREATE_LIMIT_PER_PHONE", "3")),
+            float(os.getenv("CREATE_LIMIT_PHONE_WINDOW", "3600")))
+        self.queue = AdmissionQueue(
+            int(os.getenv("CREATE_MAX_ACTIVE", "4")),
+            int(os.getenv("CREATE_MAX_QUEUED", "16")),
+            float(os.getenv("CREATE_MAX_WAIT", "5")))
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.report_every = float(os.getenv("CREATE_REPORT_EVERY", "60"))
+        self.reported = 0
+
+    def _count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+            report = (outcome.startswith("rejected") and
+                      time.monotonic() - self.reported >= self.report_every)
+            if report:
+                self.reported = time.monotonic()
+        # Report rejections at most once per interval so floods don't flood logs
+        if report:
+            print("Create rate limit: {}".format(self.metrics()))
+
+    def check(self, ip, phone):
+        """Get the rejection reason for a request, or None to let it in"""
+        if not self.by_ip.allow(ip):
+            reason = "ip"
+        elif phone and not self.by_phone.allow("".join(c for c in phone if c.isdigit())):
+            reason = "phone"
+        else:
+            return None
+        self._count("rejected_" + reason)
+        return reason
+
+    def enter(self, wait=True):
+        if self.queue.enter(wait):
+            self._count("admitted")
+            return True
+        self._count("rejected_queue")
+        return False
+
+    def leave(self):
+        self.queue.leave()
+
+    def metrics(self):
+        """Get admitted and rejected counts"""
+        with self.lock:
+            counts = dict(self.counts)
+        counts["active"] = self.queue.active
+        counts["queued"] = self.queue.queued
+        return counts
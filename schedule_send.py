@@ -1,17 +1,77 @@
-from flask_app import refresh_clients, get_sunset, send_msg
+from collections import Counter
+
+from flask_app import refresh_clients, forecast_message, send_msg
+from scheduler import plan_sends, run_plan
+from send_state import SendState, run_lock
+from profiling import profiled, should_profile
+
+
+def send_update(job, state, summary):
+    '''
+    Send sunset update for a single scheduled job, recording the outcome.
+    Failures are isolated so one bad client can't abort the run
+    '''
+    day = job.day
+    claimed = False
+    try:
+        # Raises rather than texting an error as the daily message
+        msg = forecast_message(job.location, "sunset")
+        # Planning checked hours ago, so claim the send at send time
+        claimed = state.mark_sending(job.phone, day)
+        if not claimed:
+            summary["skipped"] += 1
+            return
+        send_msg(job.phone, msg)
+    except Exception as e:
+        state.mark_failed(job.phone, day, e, claimed)
+        summary["failed"] += 1
+        print("Failed to send to {}: {}".format(job.phone, e))
+        return
+    state.mark_sent(job.phone, day)
+    summary["sent"] += 1
 
 
 def schedule_send():
     '''
-    Send update to each client
+    Send update to each client shortly before their local sunset,
+    spread over the next 24 hours. Clients already texted for the day
+    are skipped, so the job can be rerun safely after a crash, and
+    overlapping runs take turns
     '''
+    with run_lock():
+        return run_sends()
+
+
+def run_sends():
+    state = SendState()
+    summary = Counter()
+
     clients = refresh_clients()
-    for client in clients:
-        location = client['Location']
-        phone = client['Phone']
-        msg = get_sunset(location)
-        send_msg(phone, msg)
-    return len(clients)
+    planned, deferred = plan_sends(clients)
+    # Deferred clients aren't recorded, so a rerun picks them up
+    summary["deferred"] = len(deferred)
+    buckets = []
+    for bucket in planned:
+        jobs = []
+        for job in bucket.jobs:
+            if state.should_send(job.phone, job.day):
+                jobs.append(job)
+            else:
+                summary["skipped"] += 1
+        if jobs:
+            buckets.append(bucket._replace(jobs=jobs))
+
+    def send(job):
+        with profiled("schedule_send-sunset", should_profile()):
+            send_update(job, state, summary)
+
+    run_plan(buckets, send)
+    state.close()
+
+    summary["clients"] = len(clients)
+    print("Run summary: {clients} clients, {sent} sent, {skipped} skipped, {failed} failed, {deferred} deferred".format(
+        **{k: summary[k] for k in ("clients", "sent", "skipped", "failed", "deferred")}))
+    return summary
 
 
 schedule_send()
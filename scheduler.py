@@ -0,0 +1,190 @@
+import os
+import time
+import datetime
+from collections import namedtuple
+
+from suntime import Sun, SunTimeException
+from dateutil import tz
+
+from flask_app import address_to_coord, get_timezone
+from gazetteer import default_gazetteer
+from sunburst import TokenBucket, retry_delay
+
+
+# Minutes before local sunset that the daily text goes out
+LEAD_MINUTES = int(os.getenv("SEND_LEAD_MINUTES", "120"))
+# Width of each send bucket; sends in a bucket are spread across it
+SLOT_MINUTES = int(os.getenv("SEND_SLOT_MINUTES", "15"))
+# Steady outbound message rate (messages per second)
+SEND_RATE = float(os.getenv("SEND_RATE", "1"))
+# Upstream lookups while planning, kept under Nominatim's one request
+# per second. Gazetteer and shared cache answers aren't paced
+LOOKUP_RATE = float(os.getenv("SEND_LOOKUP_RATE", "1"))
+# Retries for lookups that fail outright, e.g. timeouts or open breakers
+LOOKUP_RETRIES = int(os.getenv("SEND_LOOKUP_RETRIES", "3"))
+
+# day is the subscriber's local date of the sunset, one send per day
+SendJob = namedtuple("SendJob", ["send_at", "phone", "location", "day"])
+Bucket = namedtuple("Bucket", ["timezone", "start", "end", "jobs"])
+
+
+def next_send_time(coords, now, lead):
+    """Get the first sunset-minus-LEAD time at coords that is not past"""
+    sun = Sun(coords[0], coords[1])
+    today = now.date()
+    for offset in range(3):
+        try:
+            sunset = sun.get_sunset_time(
+                today + datetime.timedelta(days=offset))
+        except SunTimeException:
+            # Polar day or night, no sunset to lead
+            continue
+        send_at = sunset.replace(tzinfo=tz.UTC) - lead
+        if send_at >= now:
+            return send_at
+    return now
+
+
+def local_day(send_at, lead, timezone):
+    """Get the local date in timezone of the sunset send_at leads up to.
+        Unlike send_at's UTC date it moves on by exactly one each day"""
+    zone = tz.gettz(timezone) or tz.UTC
+    return str((send_at + lead).astimezone(zone).date())
+
+
+def slot_start(send_at, slot):
+    """Round send_at down to the start of its slot"""
+    minutes = (send_at.hour * 60 + send_at.minute) // slot * slot
+    return send_at.replace(hour=minutes // 60, minute=minutes % 60,
+                           second=0, microsecond=0)
+
+
+def answered_locally(lookup, arg, offline):
+    """Check if lookup(arg) is answered by the shared cache or offline,
+        without an upstream call"""
+    gazetteer = default_gazetteer()
+    return lookup.peek(arg) is not None or bool(gazetteer and offline(gazetteer))
+
+
+def lookup_coords(location, limiter, retries=LOOKUP_RETRIES):
+    """Get coords of location, or -1 if it is unknown. Failed lookups are
+        retried with backoff; returns None if they never succeed"""
+    local = answered_locally(address_to_coord, location,
+                             lambda gazetteer: gazetteer.lookup(location))
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(retry_delay(attempt - 1, None, 2.0, 60.0))
+        if not local:
+            limiter.acquire()
+        try:
+            return address_to_coord(location)
+        except Exception as e:
+            error = e
+    print("Failed to locate {}: {}".format(location, error))
+    return None
+
+
+def locate(locations, rate=LOOKUP_RATE):
+    """Get (coords, timezone) for each distinct location, pacing lookups.
+        Unknown locations map to None; locations whose lookups kept
+        failing are left out"""
+    limiter = TokenBucket(rate, 1)
+    located = {}
+    for location in locations:
+        coords = lookup_coords(location, limiter)
+        if coords is None:
+            continue
+        if coords == -1:
+            located[location] = None
+            continue
+        if not answered_locally(get_timezone, coords,
+                                lambda gazetteer: gazetteer.nearest_timezone(coords)):
+            limiter.acquire()
+        try:
+            timezone = get_timezone(coords)
+        except Exception:
+            timezone = "UTC"
+        located[location] = (coords, timezone)
+    return located
+
+
+def plan_sends(clients, now=None, lead_minutes=LEAD_MINUTES,
+               slot_minutes=SLOT_MINUTES):
+    """Bucket clients by timezone and local sunset slot.
+        Returns buckets sorted by start time, and the clients deferred
+        because their location couldn't be looked up"""
+    lead = datetime.timedelta(minutes=lead_minutes)
+    slot = datetime.timedelta(minutes=slot_minutes)
+
+    # Each distinct location is only looked up once
+    clients = [c for c in clients if c.get("Location") and c.get("Phone")]
+    located = locate(sorted(set(c["Location"] for c in clients)))
+
+    # Lookups can take a while, so place slots from when they finished
+    # rather than letting slots that started meanwhile fire in a burst
+    if now is None:
+        now = datetime.datetime.now(tz.UTC)
+
+    buckets = {}
+    deferred = []
+    for client in clients:
+        location = client["Location"]
+        if location not in located:
+            # Lookups are down, leave them for a rerun rather than guess
+            deferred.append(client)
+            continue
+        found = located[location]
+        if found is None:
+            # Unknown location, try straight away so the failure is
+            # recorded and retried by reruns
+            key = ("UTC", now)
+            send_at = now
+            day = str(now.date())
+        else:
+            coords, timezone = found
+            send_at = next_send_time(coords, now, lead)
+            key = (timezone, max(slot_start(send_at, slot_minutes), now))
+            day = local_day(send_at, lead, timezone)
+        buckets.setdefault(key, []).append(
+            SendJob(send_at, client["Phone"], location, day))
+
+    planned = []
+    for (timezone, start), jobs in buckets.items():
+        jobs.sort(key=lambda job: job.send_at)
+        planned.append(Bucket(timezone, start, start + slot, jobs))
+    planned.sort(key=lambda bucket: bucket.start)
+    return planned, deferred
+
+
+def _sleep_until(when):
+    delay = (when - datetime.datetime.now(tz.UTC)).total_seconds()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def merge_slots(buckets):
+    """Combine buckets that share a slot, e.g. timezones with the same
+        sunset, into one (start, end, jobs) per slot sorted by start"""
+    slots = {}
+    for bucket in buckets:
+        slots.setdefault((bucket.start, bucket.end), []).extend(bucket.jobs)
+    merged = []
+    for (start, end), jobs in sorted(slots.items()):
+        jobs.sort(key=lambda job: job.send_at)
+        merged.append((start, end, jobs))
+    return merged
+
+
+def run_plan(buckets, send, rate=SEND_RATE):
+    """Call send(job) for every job, spreading all jobs in a slot evenly
+        over it and never exceeding RATE sends per second"""
+    limiter = TokenBucket(rate, 1)
+    sent = 0
+    for start, end, jobs in merge_slots(buckets):
+        spacing = (end - start) / len(jobs)
+        for i, job in enumerate(jobs):
+            _sleep_until(start + spacing * i)
+            limiter.acquire()
+            send(job)
+            sent += 1
+    return sent
@@ -0,0 +1,112 @@
+import os
+import fcntl
+import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
+
+
+STATE_PATH = os.getenv("SEND_STATE_DB", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "send_state.db"))
+MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "3"))
+
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+
+class SendState:
+    """Durable per-subscriber, per-day record of daily sends.
+
+        A job is claimed as SENDING right before the text goes out. Only
+        one claim can succeed, and a job whose process died mid-send is
+        treated as delivered rather than risk texting the subscriber
+        twice."""
+
+    def __init__(self, path=STATE_PATH, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sends (
+                phone TEXT NOT NULL,
+                day TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated TEXT NOT NULL,
+                PRIMARY KEY (phone, day)
+            )""")
+        self.db.commit()
+
+    def _row(self, phone, day):
+        return self.db.execute(
+            "SELECT status, attempts FROM sends WHERE phone = ? AND day = ?",
+            (phone, day)).fetchone()
+
+    def should_send(self, phone, day):
+        """Check if PHONE still needs its text for DAY"""
+        with self.lock:
+            row = self._row(phone, day)
+        if row is None:
+            return True
+        status, attempts = row
+        return status == FAILED and attempts < self.max_attempts
+
+    def _record(self, phone, day, status, error=None, only_from=None):
+        """Upsert the row for (phone, day). If ONLY_FROM is given, an
+            existing row is only changed while it has one of those
+            statuses. Returns whether a row was written"""
+        now = str(datetime.datetime.now())
+        condition = ""
+        params = [phone, day, status, 1 if status == FAILED else 0, error, now]
+        if only_from:
+            condition = "WHERE sends.status IN ({})".format(
+                ", ".join("?" for _ in only_from))
+            params.extend(only_from)
+            if status == SENDING:
+                condition += " AND sends.attempts < ?"
+                params.append(self.max_attempts)
+        with self.lock:
+            cursor = self.db.execute("""
+                INSERT INTO sends (phone, day, status, attempts, error, updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (phone, day) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = sends.attempts + excluded.attempts,
+                    error = excluded.error,
+                    updated = excluded.updated
+                """ + condition, params)
+            self.db.commit()
+        return cursor.rowcount > 0
+
+    def mark_sending(self, phone, day):
+        """Claim the send for (phone, day). Atomic across processes: only
+            succeeds if nobody has sent or is sending it and attempts are
+            left. Returns whether the claim was taken"""
+        return self._record(phone, day, SENDING, only_from=(FAILED,))
+
+    def mark_sent(self, phone, day):
+        self._record(phone, day, SENT)
+
+    def mark_failed(self, phone, day, error, claimed=False):
+        """Record a failed attempt. Unless this run holds the claim, a row
+            another run has sent or is sending is left alone"""
+        self._record(phone, day, FAILED, str(error),
+                     only_from=None if claimed else (FAILED,))
+
+    def close(self):
+        self.db.close()
+
+
+@contextmanager
+def run_lock(path=STATE_PATH + ".lock"):
+    """Hold an exclusive lock for a whole run, so an overlapping run waits
+        for the one in progress to finish instead of sending alongside it"""
+    with open(path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print("Another send run is in progress, waiting for it to finish")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
@@ -0,0 +1,397 @@
+import os
+import random
+import threading
+import time
+import datetime
+from collections import namedtuple
+
+import requests
+from dateutil import parser, tz
+
+from cache import cache_get, cache_set
+
+
+LOGIN_URL = "https://sunburst.sunsetwx.com/v1/login"
+QUALITY_URL = "https://sunburst.sunsetwx.com/v1/quality"
+
+# Status codes that mean "slow down and try again"
+RETRY_STATUSES = (429, 502, 503, 504)
+
+FORECAST_TYPES = ("sunrise", "sunset")
+
+# One forecast record per upcoming sunrise/sunset event
+Forecast = namedtuple(
+    "Forecast", ["type", "quality", "percent", "valid_at", "valid_until"])
+
+
+class SunburstError(Exception):
+    """Raised when Sunburst does not return a usable response"""
+
+
+class SunburstThrottled(SunburstError):
+    """Raised when Sunburst is still throttling after all retries"""
+
+
+#  ================== Rate Limiting ==================
+
+
+class TokenBucket:
+    """Allow RATE calls per second on average with bursts of up to BURST"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout=None):
+        """Block until a token is available. Return False if TIMEOUT
+            seconds pass first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Let concurrent callers with the same key share one in-flight call"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, timeout=None):
+        """Run fn for KEY, or wait for the caller already running it.
+            Waiting callers give up after TIMEOUT seconds"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise SunburstThrottled("Timed out waiting for Sunburst")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+def retry_delay(attempt, res, backoff, max_backoff):
+    """Get Retry-After if the response gave one, otherwise full-jitter
+        exponential backoff"""
+    delay = None
+    if res is not None:
+        try:
+            delay = float(res.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            delay = None
+    if delay is None:
+        delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+    return min(delay, max_backoff)
+
+
+def _cap(seconds, deadline):
+    """Cap SECONDS to the time left before DEADLINE, a time.monotonic()
+        value. Raises SunburstThrottled once DEADLINE has passed"""
+    if deadline is None:
+        return seconds
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise SunburstThrottled("Sunburst deadline passed")
+    return remaining if seconds is None else min(seconds, remaining)
+
+
+#  ================== Client ==================
+
+
+class SunburstClient:
+    """Sunburst API client that respects our request quota, retries
+        throttled calls with jittered backoff and coalesces identical
+        concurrent queries.
+
+        Lookups take an optional DEADLINE (a time.monotonic() value) that
+        bounds waiting for quota, retries and requests in total, so
+        interactive callers can give up long before batch jobs do"""
+
+    def __init__(self, email, password, rate=1.0, burst=5, max_retries=4,
+                 backoff=1.0, max_backoff=30.0, max_wait=20.0, timeout=10,
+                 limit=4, forecast_ttl=900):
+        self.email = email
+        self.password = password
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.flight = SingleFlight()
+        self.token_lock = threading.Lock()
+        self.token = None
+        self.token_expires = 0
+        self.limit = limit
+        self.forecast_ttl = forecast_ttl
+        self.cache_lock = threading.Lock()
+        self.cache = {}
+
+    def _sleep_before_retry(self, attempt, res, deadline=None):
+        delay = retry_delay(attempt, res, self.backoff, self.max_backoff)
+        # Don't sleep through the deadline just to give up afterwards
+        if _cap(delay, deadline) < delay:
+            raise SunburstThrottled("No time left to retry Sunburst")
+        time.sleep(delay)
+
+    def _send(self, method, url, deadline=None, **kwargs):
+        """Send request within the rate limit, retrying when throttled"""
+        res = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._sleep_before_retry(attempt - 1, res, deadline)
+            if not self.bucket.acquire(timeout=_cap(self.max_wait, deadline)):
+                raise SunburstThrottled("Local Sunburst quota exhausted")
+            try:
+                res = self.session.request(
+                    method, url, timeout=_cap(self.timeout, deadline), **kwargs)
+            except requests.RequestException:
+                res = None
+                continue
+            if res.status_code not in RETRY_STATUSES:
+                return res
+        raise SunburstThrottled("Sunburst still throttling after {} attempts".format(
+            self.max_retries + 1))
+
+    def _login(self, deadline=None):
+        """Get Sunburst API token via POST"""
+        res = self._send("POST", LOGIN_URL, deadline,
+                         auth=(self.email, self.password))
+        try:
+            data = res.json()
+        except ValueError:
+            raise SunburstError("Invalid Sunburst login response")
+        token = data.get("access_token") or data.get("token")
+        if not token:
+            raise SunburstError("Sunburst login failed")
+        # Refresh a minute early so in-flight requests never use a stale token
+        expires_in = float(data.get("expires_in", 3600))
+        self.token = token
+        self.token_expires = time.monotonic() + max(expires_in - 60, 0)
+        return token
+
+    def _auth_header(self, force=False, deadline=None):
+        wait = _cap(None, deadline)
+        if not self.token_lock.acquire(timeout=-1 if wait is None else wait):
+            raise SunburstThrottled("Timed out waiting for Sunburst login")
+        try:
+            if force or self.token is None or time.monotonic() >= self.token_expires:
+                self._login(deadline)
+            return {"Authorization": "Bearer " + self.token}
+        finally:
+            self.token_lock.release()
+
+    def _get_quality(self, params, deadline=None):
+        res = self._send("GET", QUALITY_URL, deadline, params=params,
+                         headers=self._auth_header(deadline=deadline))
+        if res.status_code == 401:
+            res = self._send("GET", QUALITY_URL, deadline, params=params,
+                             headers=self._auth_header(True, deadline))
+        try:
+            return res.json()
+        except ValueError:
+            raise SunburstError("Invalid Sunburst quality response")
+
+    def quality(self, geo, deadline=None, **params):
+        """Get raw quality response for GEO ("lat,lng")"""
+        params["geo"] = geo
+        key = ("quality",) + tuple(sorted(params.items()))
+        return self.flight.do(key, lambda: self._get_quality(params, deadline),
+                              _cap(None, deadline))
+
+    def _fetch_forecasts(self, geo, deadline=None):
+        """Fetch every upcoming sunrise and sunset Sunburst offers for GEO,
+            only asking per type for what the combined call left out"""
+        records = parse_forecasts(self.quality(geo, deadline, limit=self.limit))
+        for kind in FORECAST_TYPES:
+            if not any(f.type == kind for f in records):
+                records.extend(parse_forecasts(
+                    self.quality(geo, deadline, type=kind, limit=self.limit)))
+        return sort_forecasts(records)
+
+    def _shared_forecasts(self, geo, deadline=None, refresh=False):
+        """Get forecasts from the cache shared with other processes,
+            fetching and sharing them on a miss or when REFRESH is set"""
+        hit = None if refresh else cache_get("forecast", geo)
+        if hit is not None:
+            return load_forecasts(hit)
+        records = self._fetch_forecasts(geo, deadline)
+        cache_set("forecast", geo, dump_forecasts(records))
+        return records
+
+    def forecasts(self, geo, deadline=None, refresh=False):
+        """Get upcoming forecast records for GEO, reusing recent results.
+            REFRESH fetches them again and rewrites both caches"""
+        now = time.monotonic()
+        with self.cache_lock:
+            cached = self.cache.get(geo)
+        if not refresh and cached is not None and cached[0] > now:
+            return cached[1]
+
+        records = self.flight.do(("forecasts", geo, refresh),
+                                 lambda: self._shared_forecasts(geo, deadline, refresh),
+                                 _cap(None, deadline))
+        with self.cache_lock:
+            if len(self.cache) >= 4096:
+                self.cache = {k: v for k, v in self.cache.items()
+                              if v[0] > now}
+            self.cache[geo] = (now + self.forecast_ttl, records)
+        return records
+
+    def next_forecast(self, geo, kind="sunset", deadline=None):
+        """Get the next forecast of type KIND at GEO"""
+        return select_forecast(self.forecasts(geo, deadline), kind)
+
+    def quality_percent(self, geo, kind="sunset", deadline=None):
+        """Get the quality percent of the next KIND event at GEO"""
+        return self.next_forecast(geo, kind, deadline).percent
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=tz.UTC)
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    try:
+        parsed = parser.isoparse(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=tz.UTC)
+    return parsed
+
+
+def dump_forecasts(records):
+    """Turn Forecast records into JSON-serialisable rows"""
+    return [[f.type, f.quality, f.percent,
+             f.valid_at and f.valid_at.isoformat(),
+             f.valid_until and f.valid_until.isoformat()] for f in records]
+
+
+def load_forecasts(rows):
+    """Turn rows from dump_forecasts back into Forecast records"""
+    return [Forecast(kind, quality, percent,
+                     _parse_time(valid_at), _parse_time(valid_until))
+            for kind, quality, percent, valid_at, valid_until in rows]
+
+
+def sort_forecasts(records):
+    """Sort Forecast records by event time"""
+    records.sort(key=lambda f: f.valid_at or _EPOCH)
+    return records
+
+
+def select_forecast(records, kind="sunset"):
+    """Get the next forecast of type KIND from sorted records"""
+    # Keep an event for a while after it starts so replies sent during
+    # sunset still describe it
+    cutoff = datetime.datetime.now(tz.UTC) - datetime.timedelta(hours=1)
+    for forecast in records:
+        if forecast.type != kind:
+            continue
+        if forecast.valid_at is None or forecast.valid_at >= cutoff:
+            return forecast
+    raise SunburstError("No {} forecast in Sunburst response".format(kind))
+
+
+def parse_forecasts(data):
+    """Parse a Sunburst quality response into Forecast records"""
+    try:
+        features = data["features"]
+    except (KeyError, TypeError):
+        raise SunburstError("No features in Sunburst response")
+
+    records = []
+    for feature in features:
+        properties = feature.get("properties") or {}
+        try:
+            percent = float(properties["quality_percent"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        records.append(Forecast(
+            type=str(properties.get("type", "sunset")).lower(),
+            quality=properties.get("quality"),
+            percent=percent,
+            valid_at=_parse_time(properties.get("valid_at")),
+            valid_until=_parse_time(properties.get("valid_until")),
+        ))
+    return records
+
+
+def quota_share():
+    """Get this process's (rate, burst) share of the account quota.
+        SUNBURST_RATE and SUNBURST_BURST are for the whole account and
+        each process only knows its own bucket, so they are split evenly
+        between the SUNBURST_PROCESSES processes that call Sunburst"""
+    processes = max(int(os.getenv("SUNBURST_PROCESSES", "1")), 1)
+    rate = float(os.getenv("SUNBURST_RATE", "1")) / processes
+    burst = max(int(os.getenv("SUNBURST_BURST", "5")) // processes, 1)
+    return rate, burst
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def default_client():
+    """Get the shared Sunburst client configured from the environment"""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            rate, burst = quota_share()
+            _default_client = SunburstClient(
+                os.getenv("SUNBURST_EMAIL"),
+                os.getenv("SUNBURST_PW"),
+                rate=rate,
+                burst=burst,
+                max_retries=int(os.getenv("SUNBURST_MAX_RETRIES", "4")),
+                max_wait=float(os.getenv("SUNBURST_MAX_WAIT", "20")),
+                limit=int(os.getenv("SUNBURST_LIMIT", "4")),
+                forecast_ttl=float(os.getenv("SUNBURST_FORECAST_TTL", "900")),
+            )
+        return _default_client
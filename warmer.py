@@ -0,0 +1,141 @@
+import os
+import time
+import fcntl
+import tempfile
+import threading
+from collections import namedtuple
+
+from cache import ttl_for
+from sunburst import SunburstError, TokenBucket, select_forecast
+
+
+# Seconds between warming passes, must be under the shared forecast TTL
+# so other workers' cached forecasts are rewritten before they expire
+WARM_INTERVAL = float(os.getenv("WARM_INTERVAL", "600"))
+# Locations warmed per second, each costing a few upstream calls on a miss
+WARM_RATE = float(os.getenv("WARM_RATE", "0.5"))
+# How long a warmed entry is served without being refreshed
+WARM_TTL = float(os.getenv("WARM_TTL", str(2 * WARM_INTERVAL)))
+# Only the process holding this lock warms; other workers on the host
+# still reuse its lookups through the shared cache
+WARM_LOCK = os.getenv("WARM_LOCK", os.path.join(
+    tempfile.gettempdir(), "sundown-warmer.lock"))
+
+
+class WarmEntry(namedtuple("WarmEntry", ["coords", "timezone", "forecasts", "expires"])):
+    """Pre-resolved coords, timezone and forecasts for grid coords"""
+
+    def quality_percent(self, kind="sunset"):
+        """Get average quality of the next KIND event across the grid"""
+        percents = [select_forecast(records, kind).percent
+                    for records in self.forecasts.values()]
+        if not percents:
+            raise SunburstError("No warmed forecasts")
+        return sum(percents) / float(len(percents))
+
+
+class ForecastStore:
+    """In-process store of warmed locations"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, address):
+        """Get fresh WarmEntry for address, or None"""
+        with self.lock:
+            entry = self.entries.get(address)
+        if entry is None or entry.expires <= time.monotonic():
+            return None
+        return entry
+
+    def put(self, address, entry):
+        with self.lock:
+            self.entries[address] = entry
+
+    def retain(self, addresses):
+        """Drop entries for locations nobody subscribes to any more"""
+        addresses = set(addresses)
+        with self.lock:
+            for address in [a for a in self.entries if a not in addresses]:
+                del self.entries[address]
+
+
+class ForecastWarmer:
+    """Background thread that periodically resolves every subscriber
+        location into the store within a rate budget"""
+
+    def __init__(self, store, list_locations, resolve, interval=WARM_INTERVAL,
+                 rate=WARM_RATE, ttl=WARM_TTL, forecast_ttl=None):
+        self.store = store
+        self.list_locations = list_locations
+        self.resolve = resolve
+        self.interval = interval
+        self.limiter = TokenBucket(rate, 1)
+        self.ttl = ttl
+        self.forecast_ttl = forecast_ttl
+        self.thread = None
+        self.lock_file = None
+        self.start_lock = threading.Lock()
+        self.started = False
+
+    def warm(self):
+        """Warm every location once. Returns (warmed, failed) counts"""
+        locations = self.list_locations()
+        self.store.retain(locations)
+        warmed = failed = 0
+        for location in locations:
+            self.limiter.acquire()
+            try:
+                coords, timezone, forecasts = self.resolve(location)
+            except Exception as e:
+                failed += 1
+                print("Failed to warm {}: {}".format(location, e))
+                continue
+            self.store.put(location, WarmEntry(
+                coords, timezone, forecasts, time.monotonic() + self.ttl))
+            warmed += 1
+        return warmed, failed
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            try:
+                self.warm()
+            except Exception as e:
+                print("Forecast warming failed: {}".format(e))
+            time.sleep(max(self.interval - (time.monotonic() - start), 0))
+
+    def _take_lock(self, path):
+        """Hold an exclusive lock on path for the life of the process.
+            Return False if another process already holds it"""
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def start(self, lock_path=WARM_LOCK):
+        """Start warming in a daemon thread, unless another process on
+            this host is already warming. Only the first call does anything.
+            Raises ValueError if passes are too far apart to keep the
+            shared forecasts fresh"""
+        forecast_ttl = self.forecast_ttl
+        if forecast_ttl is None:
+            forecast_ttl = ttl_for("forecast")
+        if self.interval >= forecast_ttl:
+            raise ValueError(
+                "WARM_INTERVAL ({}s) must be below the forecast TTL ({}s, "
+                "CACHE_TTL_FORECAST)".format(self.interval, forecast_ttl))
+        with self.start_lock:
+            if self.started:
+                return self
+            self.started = True
+            if self._take_lock(lock_path):
+                self.thread = threading.Thread(
+                    target=self.run, name="forecast-warmer", daemon=True)
+                self.thread.start()
+        return self